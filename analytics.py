@@ -0,0 +1,150 @@
+# Roster analytics: a generated schedule turned once into a staff x day
+# categorical frame, and the checks the app shows computed from it with
+# whole-array pandas/numpy operations instead of loops over staff and days:
+#
+#   coverage()       staff on each shift per day
+#   shortage()       missing staff per shift and day against the actual
+#                    demand (headcount, weekday/date headcount in the rules)
+#   staff_totals()   公/夜/日 per staff, longest work streak and rule breaks
+#   quality()        the roster's scores in one dict
+#
+# The rules are the engine's (RuleSet) and the scores follow its definitions:
+# shortage() sums to ScheduleGenerator.coverage_shortage() and the streak and
+# next-day checks are those of LocalSearch.row_cost(), including the days
+# carried over from the previous month. The engine itself stays stdlib-only.
+
+import calendar
+
+import numpy as np
+import pandas as pd
+
+from scheduler import C_EARLY, C_LATE, C_NIGHT, CARRY_DAYS, CODE_OF, IS_WORK_CODE, NUM_CODES, SHIFT_CODES, \
+    SHIFT_DAY, SHIFT_NIGHT, SHIFT_OFF, T_AVOID, T_FORBID, RuleSet
+
+SHIFTS = SHIFT_CODES[1:]
+SHIFT_DTYPE = pd.CategoricalDtype(SHIFTS)
+# Cell text per engine code, "" for an empty cell
+CELL_TEXT = np.array([""] + SHIFTS, dtype=object)
+TOTAL_SHIFTS = [SHIFT_OFF, SHIFT_NIGHT, SHIFT_DAY]
+IS_WORK = np.array(IS_WORK_CODE)
+
+
+class RosterAnalytics:
+    def __init__(self, config, schedule):
+        # schedule is a result['schedule'] ({staff id: row}) for config's
+        # month and staff
+        self.staff_list = config['staff_list']
+        self.year = config['year']
+        self.month = config['month']
+        self.days_in_month = calendar.monthrange(self.year, self.month)[1]
+        self.days = list(range(1, self.days_in_month + 1))
+        self.rules = RuleSet(config, self.year, self.month, self.days_in_month)
+        self.staff_ids = [s['id'] for s in self.staff_list]
+        self.names = [s['name'] for s in self.staff_list]
+
+        # Engine codes (0 = empty) as one int8 array; the categorical frame
+        # shares its codes
+        rows = [schedule[sid][1:self.days_in_month + 1] for sid in self.staff_ids]
+        cells = pd.Categorical(np.array(rows, dtype=object).reshape(-1), dtype=SHIFT_DTYPE)
+        self.codes = (cells.codes + 1).astype(np.int8).reshape(len(rows), self.days_in_month)
+        self.frame = pd.DataFrame({d: pd.Categorical.from_codes(self.codes[:, d - 1] - 1, dtype=SHIFT_DTYPE)
+                                   for d in self.days}, index=self.staff_ids)
+
+        # The codes with the last CARRY_DAYS of the previous month in front
+        # (config['history'], see ScheduleGenerator.carry_over), for the
+        # checks that look back across the month boundary
+        history = config.get('history') or {}
+        carried = np.zeros((len(rows), CARRY_DAYS), dtype=np.int8)
+        for i, sid in enumerate(self.staff_ids):
+            tail = [CODE_OF.get(shift, 0) for shift in history.get(sid, history.get(str(sid), []))][-CARRY_DAYS:]
+            if tail:
+                carried[i, CARRY_DAYS - len(tail):] = tail
+        self.extended = np.hstack([carried, self.codes])
+
+    def table(self):
+        # The roster as shown and exported: 氏名 then one column per day
+        table = pd.DataFrame(CELL_TEXT[self.codes], columns=[str(d) for d in self.days])
+        table.insert(0, "氏名", self.names)
+        return table
+
+    def coverage(self):
+        # Staff per shift (rows) and day (columns)
+        return pd.DataFrame(self.coverage_counts(SHIFTS), index=SHIFTS, columns=self.days)
+
+    def coverage_counts(self, shifts):
+        return np.stack([(self.codes == CODE_OF[shift]).sum(axis=0) for shift in shifts])
+
+    def demand(self):
+        demand = self.rules.demand
+        return pd.DataFrame([[demand[d].get(shift, 0) for d in self.days] for shift in self.rules.shifts],
+                            index=self.rules.shifts, columns=self.days)
+
+    def shortage(self):
+        # Missing staff per demanded shift (rows) and day (columns)
+        shifts = self.rules.shifts
+        missing = self.demand().to_numpy() - self.coverage_counts(shifts)
+        return pd.DataFrame(np.maximum(missing, 0), index=shifts, columns=self.days)
+
+    def shortage_labels(self, shortage=None):
+        # Per day, the short shifts joined as "日/夜" ("" if none)
+        if shortage is None:
+            shortage = self.shortage()
+        marks = np.where(shortage.to_numpy() > 0, shortage.index.to_numpy()[:, None], "")
+        return pd.Series(["/".join(filter(None, day)) for day in marks.T], index=self.days)
+
+    def work_runs(self):
+        # Length of the work streak (明 included) ending on each day of the
+        # extended codes, 0 on days off
+        work = IS_WORK[self.extended]
+        count = np.cumsum(work, axis=1)
+        return count - np.maximum.accumulate(np.where(work, 0, count), axis=1)
+
+    def streak_violations(self):
+        # Per staff, the work days that break the streak limit: 早/日/遅 once
+        # the streak reached it, 夜 only beyond it (its 明 is the extra day)
+        before = self.work_runs()[:, CARRY_DAYS - 1:-1]
+        limit = np.array(self.rules.max_streak)[:, None]
+        codes = self.codes
+        day_work = (codes >= C_EARLY) & (codes <= C_LATE)
+        return ((day_work & (before >= limit)) | ((codes == C_NIGHT) & (before > limit))).sum(axis=1)
+
+    def longest_streaks(self):
+        # Longest work streak reaching into the month
+        return self.work_runs()[:, CARRY_DAYS:].max(axis=1)
+
+    def transition_counts(self):
+        # Per staff, the next-day pairs the rules avoid and forbid (e.g.
+        # 遅→早 and 日→日 by default), from the last carried day on
+        table = np.frombuffer(self.rules.transition, dtype=np.uint8).reshape(NUM_CODES, NUM_CODES)
+        kinds = table[self.extended[:, CARRY_DAYS - 1:-1], self.codes]
+        return (kinds == T_AVOID).sum(axis=1), (kinds == T_FORBID).sum(axis=1)
+
+    def staff_totals(self):
+        # One row per staff (by name): 公/夜/日 counts, longest streak and rule breaks
+        totals = pd.DataFrame({shift: (self.codes == CODE_OF[shift]).sum(axis=1) for shift in TOTAL_SHIFTS},
+                              index=self.names)
+        avoided, forbidden = self.transition_counts()
+        totals["最長連勤"] = self.longest_streaks()
+        totals["連勤超過"] = self.streak_violations()
+        totals["避けたい並び"] = avoided
+        totals["禁止の並び"] = forbidden
+        return totals
+
+    def quality(self, shortage=None):
+        # Scores of the whole roster; night_spread is the gap between the most
+        # and fewest 夜 among the staff allowed to work nights
+        if shortage is None:
+            shortage = self.shortage()
+        avoided, forbidden = self.transition_counts()
+        nights = (self.codes == C_NIGHT).sum(axis=1)
+        night_rows = np.array([not s.get('allowed_shifts') or SHIFT_NIGHT in s['allowed_shifts']
+                               for s in self.staff_list], dtype=bool)
+        return {
+            'shortage': int(shortage.to_numpy().sum()),
+            'shortage_by_shift': {shift: int(n) for shift, n in shortage.sum(axis=1).items()},
+            'short_days': int((shortage > 0).any(axis=0).sum()),
+            'streak_violations': int(self.streak_violations().sum()),
+            'avoided_transitions': int(avoided.sum()),
+            'forbidden_transitions': int(forbidden.sum()),
+            'night_spread': int(np.ptp(nights[night_rows])) if night_rows.any() else 0,
+        }
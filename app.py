@@ -1,443 +1,16 @@
 import streamlit as st
 import pandas as pd
-import random
-import calendar
+import os
 import time
+import calendar
+import copy
 from datetime import date
 
-# --- Constants ---
-SHIFT_EARLY = '早'
-SHIFT_DAY = '日'
-SHIFT_LATE = '遅'
-SHIFT_NIGHT = '夜'
-SHIFT_DAWN = '明'
-SHIFT_OFF = '公'
-SHIFT_PAID = '有'
-
-DEFAULT_HEADCOUNT = {
-    SHIFT_EARLY: 2,
-    SHIFT_DAY: 1,
-    SHIFT_LATE: 2,
-    SHIFT_NIGHT: 1
-}
-
-MAX_CONSECUTIVE_WORK_DAYS = 3
-MONTHLY_PUBLIC_OFF_DAYS = 9
-MAX_NIGHT_SHIFTS = 6
-MAX_DAY_SHIFTS = 2
-
-ALL_SHIFTS = [SHIFT_EARLY, SHIFT_DAY, SHIFT_LATE, SHIFT_NIGHT]
-NO_NIGHT_SHIFTS = [SHIFT_EARLY, SHIFT_DAY, SHIFT_LATE]
-
-# --- Logic Class ---
-
-class ScheduleGenerator:
-    def __init__(self, config):
-        self.year = config['year']
-        self.month = config['month']
-        self.staff_list = config['staff_list']
-        self.headcount = config.get('headcount', DEFAULT_HEADCOUNT)
-        self.days_in_month = calendar.monthrange(self.year, self.month)[1]
-        self.days = list(range(1, self.days_in_month + 1))
-
-    def is_work_shift(self, shift):
-        return shift in [SHIFT_EARLY, SHIFT_DAY, SHIFT_LATE, SHIFT_NIGHT, SHIFT_DAWN]
-
-    def shuffle_list(self, lst):
-        random.shuffle(lst)
-
-    def generate(self):
-        # Best of N Approach
-        max_retries = 500
-        best_schedule = None
-        min_deficit = float('inf')
-
-        for attempt in range(max_retries):
-            schedule = {staff['id']: [None] * (self.days_in_month + 1) for staff in self.staff_list}
-            
-            # 1. Pre-fill Requests
-            for staff in self.staff_list:
-                requests = staff.get('requests', {})
-                for day_str, shift in requests.items():
-                    day = int(day_str)
-                    schedule[staff['id']][day] = shift
-                    if shift == SHIFT_NIGHT:
-                        if day + 1 <= self.days_in_month:
-                            schedule[staff['id']][day + 1] = SHIFT_DAWN
-                        if day + 2 <= self.days_in_month:
-                             # Only set if not already set (though request priority should handle it, logic implies strictly OFF after Dawn)
-                             # In JS: schedule[staff.id][day + 2] = C.SHIFT_OFF;
-                             schedule[staff['id']][day + 2] = SHIFT_OFF
-
-            current_deficit = 0
-
-            for day in self.days:
-                # Count assigned
-                assigned_counts = {k: 0 for k in self.headcount}
-                for staff in self.staff_list:
-                    s = schedule[staff['id']][day]
-                    if s in assigned_counts:
-                        assigned_counts[s] += 1
-                
-                # Needs
-                needs = []
-                for shift, count in self.headcount.items():
-                    needed = count - assigned_counts[shift]
-                    if needed > 0:
-                        needs.extend([shift] * needed)
-                
-                needs.sort(key=lambda x: 0 if x == SHIFT_NIGHT else 1)
-
-                # Available Staff
-                available_staff_ids = [s['id'] for s in self.staff_list if schedule[s['id']][day] is None]
-
-                # Check previous day sequences (Dawn/Night logic)
-                true_available = []
-                for sid in available_staff_ids:
-                    prev_shift = schedule[sid][day - 1] if day > 1 else None
-                    
-                    if prev_shift == SHIFT_NIGHT:
-                         schedule[sid][day] = SHIFT_DAWN
-                    elif prev_shift == SHIFT_DAWN:
-                         schedule[sid][day] = SHIFT_OFF
-                    else:
-                        true_available.append(sid)
-                
-                available_staff_ids = true_available
-                self.shuffle_list(available_staff_ids)
-
-                # Capacity Ratio
-                est_max_shifts = self.days_in_month - MONTHLY_PUBLIC_OFF_DAYS
-                total_capacity = len(self.staff_list) * est_max_shifts
-                total_required = sum(self.headcount.values()) * self.days_in_month
-                
-                # JS Logic: const capacityRatio = Math.min(1.0, totalCapacity / totalRequired);
-                # Used later for specific shifts
-
-                for shift_type in needs:
-                    # Sort candidates
-                    def count_shifts(sid):
-                        c = 0
-                        for d in range(1, self.days_in_month + 1):
-                            if schedule[sid][d] == shift_type:
-                                c += 1
-                        return c
-                    
-                    available_staff_ids.sort(key=count_shifts)
-
-                    # Probabilistic Skip
-                    if shift_type in [SHIFT_DAY, SHIFT_NIGHT]:
-                        max_shifts = MAX_NIGHT_SHIFTS if shift_type == SHIFT_NIGHT else MAX_DAY_SHIFTS
-                        
-                        remaining_capacity = 0
-                        for s in self.staff_list:
-                            if not s.get('allowed_shifts') or shift_type in s.get('allowed_shifts', []):
-                                assigned_so_far = sum(1 for d in range(1, self.days_in_month + 1) if schedule[s['id']][d] == shift_type)
-                                remaining_capacity += max(0, max_shifts - assigned_so_far)
-                        
-                        remaining_days = self.days_in_month - day + 1
-                        remaining_demand = remaining_days * self.headcount[shift_type]
-                        
-                        dynamic_ratio = 1.0
-                        if remaining_demand > 0:
-                            dynamic_ratio = remaining_capacity / remaining_demand
-                            if dynamic_ratio > 1.0: dynamic_ratio = 1.0
-                        
-                        if dynamic_ratio < 1.0:
-                            if random.random() > dynamic_ratio:
-                                current_deficit += 1
-                                continue
-
-                    assigned_to = None
-                    best_candidate_idx = -1
-                    fallback_candidate_idx = -1
-
-                    for i, sid in enumerate(available_staff_ids):
-                        staff = next(s for s in self.staff_list if s['id'] == sid)
-
-                        # Allowed check
-                        if staff.get('allowed_shifts') and shift_type not in staff['allowed_shifts']:
-                            continue
-                        
-                        # Max Consecutive
-                        streak = 0
-                        for k in range(1, 6):
-                            if day - k < 1: break
-                            if self.is_work_shift(schedule[sid][day - k]):
-                                streak += 1
-                            else:
-                                break
-                        
-                        if shift_type != SHIFT_NIGHT:
-                            if streak >= MAX_CONSECUTIVE_WORK_DAYS: continue
-                        
-                        if shift_type == SHIFT_DAY:
-                            # No consecutive Day
-                            if day > 1 and schedule[sid][day - 1] == SHIFT_DAY: continue
-                            
-                            day_count = sum(1 for d in range(1, self.days_in_month + 1) if schedule[sid][d] == SHIFT_DAY)
-                            if day_count >= MAX_DAY_SHIFTS: continue
-
-                        if shift_type == SHIFT_NIGHT:
-                            if streak > MAX_CONSECUTIVE_WORK_DAYS: continue # >3 allowed if Night
-                            
-                            night_count = sum(1 for d in range(1, self.days_in_month + 1) if schedule[sid][d] == SHIFT_NIGHT)
-                            if night_count >= MAX_NIGHT_SHIFTS: continue
-
-                            if day + 1 <= self.days_in_month and schedule[sid][day + 1] is not None:
-                                continue
-                        
-                        # Soft Constraint: Late -> Early
-                        prev_shift = schedule[sid][day - 1] if day > 1 else None
-                        if shift_type == SHIFT_EARLY and prev_shift == SHIFT_LATE:
-                            if fallback_candidate_idx == -1:
-                                fallback_candidate_idx = i
-                            continue
-                        
-                        best_candidate_idx = i
-                        break
-                    
-                    final_idx = -1
-                    if best_candidate_idx != -1:
-                        final_idx = best_candidate_idx
-                    elif fallback_candidate_idx != -1:
-                        final_idx = fallback_candidate_idx
-                    
-                    if final_idx != -1:
-                        sid = available_staff_ids[final_idx]
-                        schedule[sid][day] = shift_type
-                        
-                        if shift_type == SHIFT_NIGHT:
-                            if day + 1 <= self.days_in_month:
-                                schedule[sid][day + 1] = SHIFT_DAWN
-                            if day + 2 <= self.days_in_month and schedule[sid][day + 2] is None:
-                                schedule[sid][day + 2] = SHIFT_OFF
-                        
-                        available_staff_ids.pop(final_idx)
-                        assigned_to = sid
-                    
-                    if not assigned_to:
-                        current_deficit += 1
-                        continue
-                
-                # Fill rest with OFF
-                for sid in available_staff_ids:
-                    schedule[sid][day] = SHIFT_OFF
-            
-            if current_deficit == 0:
-                return self.finalize_schedule(schedule)
-            
-            if current_deficit < min_deficit:
-                min_deficit = current_deficit
-                best_schedule = schedule
-        
-        if best_schedule:
-            print(f"Best schedule found with deficit: {min_deficit}")
-            return self.finalize_schedule(best_schedule)
-        
-        return {'success': False}
-
-    def finalize_schedule(self, schedule):
-        # Enforce 9 Public Holidays
-        for staff in self.staff_list:
-            sid = staff['id']
-            off_days_indices = []
-            requests = staff.get('requests', {})
-            
-            for d in range(1, self.days_in_month + 1):
-                if schedule[sid][d] == SHIFT_OFF:
-                    # Check if requested
-                    if str(d) in requests and requests[str(d)] == SHIFT_OFF:
-                        pass
-                    else:
-                        off_days_indices.append(d)
-            
-            current_off_count = sum(1 for d in range(1, self.days_in_month + 1) if schedule[sid][d] == SHIFT_OFF)
-
-            # Case 1: Too many holidays
-            if current_off_count > MONTHLY_PUBLIC_OFF_DAYS:
-                excess = current_off_count - MONTHLY_PUBLIC_OFF_DAYS
-                self.shuffle_list(off_days_indices)
-                
-                removed = 0
-                
-                # Pass 1: Fill Shortages
-                for k in range(len(off_days_indices)):
-                    if removed >= excess: break
-                    d_idx = off_days_indices[k]
-                    
-                    cE, cD, cL = 0, 0, 0
-                    for s in self.staff_list:
-                         sh = schedule[s['id']][d_idx]
-                         if sh == SHIFT_EARLY: cE += 1
-                         if sh == SHIFT_DAY: cD += 1
-                         if sh == SHIFT_LATE: cL += 1
-                    
-                    needE = cE < self.headcount[SHIFT_EARLY]
-                    needD = cD < self.headcount[SHIFT_DAY]
-                    needL = cL < self.headcount[SHIFT_LATE]
-
-                    prev_shift = schedule[sid][d_idx - 1] if d_idx > 1 else None
-
-                    target_shift = None
-                    allowed = staff.get('allowed_shifts', [])
-
-                    if needD and (not allowed or SHIFT_DAY in allowed) and prev_shift != SHIFT_DAY:
-                        target_shift = SHIFT_DAY
-                    elif needE and (not allowed or SHIFT_EARLY in allowed):
-                         target_shift = SHIFT_EARLY
-                    elif needL and (not allowed or SHIFT_LATE in allowed):
-                         target_shift = SHIFT_LATE
-                    
-                    if target_shift:
-                        schedule[sid][d_idx] = target_shift
-                        removed += 1
-                        off_days_indices[k] = -1
-                
-                # Pass 2: Overfill
-                if removed < excess:
-                    for k in range(len(off_days_indices)):
-                        if removed >= excess: break
-                        d_idx = off_days_indices[k]
-                        if d_idx == -1: continue
-                        
-                        prev_shift = schedule[sid][d_idx - 1] if d_idx > 1 else None
-                        target_shift = None
-                        allowed = staff.get('allowed_shifts', [])
-
-                        if (not allowed or SHIFT_DAY in allowed) and prev_shift != SHIFT_DAY:
-                            target_shift = SHIFT_DAY
-                        elif (not allowed or SHIFT_EARLY in allowed):
-                            target_shift = SHIFT_EARLY
-                        elif (not allowed or SHIFT_LATE in allowed):
-                            target_shift = SHIFT_LATE
-                        
-                        if target_shift:
-                            schedule[sid][d_idx] = target_shift
-                            removed += 1
-            
-            # Case 2: Not enough holidays
-            elif current_off_count < MONTHLY_PUBLIC_OFF_DAYS:
-                deficit = MONTHLY_PUBLIC_OFF_DAYS - current_off_count
-                work_indices = []
-                for d in range(1, self.days_in_month + 1):
-                    if str(d) in requests: continue
-                    s = schedule[sid][d]
-                    if s in [SHIFT_EARLY, SHIFT_DAY, SHIFT_LATE]:
-                        work_indices.append(d)
-                
-                self.shuffle_list(work_indices)
-                added = 0
-                for k in range(len(work_indices)):
-                    if added >= deficit: break
-                    schedule[sid][work_indices[k]] = SHIFT_OFF
-                    added += 1
-
-            # --- Enforce 2 DAY Shifts ---
-            allowed = staff.get('allowed_shifts', [])
-            if not allowed or SHIFT_DAY in allowed:
-                day_indices = []
-                for d in range(1, self.days_in_month + 1):
-                    if schedule[sid][d] == SHIFT_DAY:
-                        if not (str(d) in requests and requests[str(d)] == SHIFT_DAY):
-                            day_indices.append(d)
-                
-                current_day_count = sum(1 for d in range(1, self.days_in_month + 1) if schedule[sid][d] == SHIFT_DAY)
-
-                if current_day_count > MAX_DAY_SHIFTS:
-                    excess = current_day_count - MAX_DAY_SHIFTS
-                    self.shuffle_list(day_indices)
-                    changed = 0
-                    for k in range(len(day_indices)):
-                        if changed >= excess: break
-                        d = day_indices[k]
-                        prev_shift = schedule[sid][d - 1] if d > 1 else None
-                        
-                        target = None
-                        if (not allowed or SHIFT_EARLY in allowed) and prev_shift != SHIFT_LATE:
-                            target = SHIFT_EARLY
-                        elif (not allowed or SHIFT_LATE in allowed):
-                             target = SHIFT_LATE
-                        elif (not allowed or SHIFT_EARLY in allowed):
-                             target = SHIFT_EARLY
-                        
-                        if target:
-                            schedule[sid][d] = target
-                            changed += 1
-                
-                elif current_day_count < MAX_DAY_SHIFTS:
-                    deficit = MAX_DAY_SHIFTS - current_day_count
-                    candidates = []
-                    for d in range(1, self.days_in_month + 1):
-                        if str(d) in requests: continue
-                        s = schedule[sid][d]
-                        if s in [SHIFT_EARLY, SHIFT_LATE]:
-                            candidates.append(d)
-                    
-                    self.shuffle_list(candidates)
-                    changed = 0
-                    for k in range(len(candidates)):
-                         if changed >= deficit: break
-                         d = candidates[k]
-                         curr = schedule[sid][d]
-
-                         # Critical Headcount Check
-                         type_count = 0
-                         for s in self.staff_list:
-                             if schedule[s['id']][d] == curr: type_count += 1
-                        
-                         if type_count <= self.headcount[curr]: continue
-
-                         prev_shift = schedule[sid][d - 1] if d > 1 else None
-                         next_shift = schedule[sid][d + 1] if d < self.days_in_month else None
-                         if prev_shift == SHIFT_DAY or next_shift == SHIFT_DAY: continue
-                         
-                         schedule[sid][d] = SHIFT_DAY
-                         changed += 1
-
-        # --- Post Processing: Early/Late 2 per day ---
-        for day in range(1, self.days_in_month + 1):
-            early_count = 0
-            late_count = 0
-            day_staff_ids = []
-
-            for s in self.staff_list:
-                sh = schedule[s['id']][day]
-                if sh == SHIFT_EARLY: early_count += 1
-                if sh == SHIFT_LATE: late_count += 1
-                if sh == SHIFT_DAY:
-                     req = s.get('requests', {})
-                     if not (str(day) in req and req[str(day)] == SHIFT_DAY):
-                         day_staff_ids.append(s['id'])
-            
-            # Fill Early
-            while early_count < self.headcount[SHIFT_EARLY] and day_staff_ids:
-                sid = day_staff_ids.pop()
-                staff = next(s for s in self.staff_list if s['id'] == sid)
-                allowed = staff.get('allowed_shifts', [])
-                if not allowed or SHIFT_EARLY in allowed:
-                    schedule[sid][day] = SHIFT_EARLY
-                    early_count += 1
-            
-             # Recount Day staff
-            day_staff_ids = []
-            for s in self.staff_list:
-                sh = schedule[s['id']][day]
-                if sh == SHIFT_DAY:
-                     req = s.get('requests', {})
-                     if not (str(day) in req and req[str(day)] == SHIFT_DAY):
-                         day_staff_ids.append(s['id'])
-
-            # Fill Late
-            while late_count < self.headcount[SHIFT_LATE] and day_staff_ids:
-                sid = day_staff_ids.pop()
-                staff = next(s for s in self.staff_list if s['id'] == sid)
-                allowed = staff.get('allowed_shifts', [])
-                if not allowed or SHIFT_LATE in allowed:
-                    schedule[sid][day] = SHIFT_LATE
-                    late_count += 1
-
-        return {'success': True, 'schedule': schedule, 'days': self.days}
+from analytics import RosterAnalytics
+from scheduler import ALL_SHIFTS, DEFAULT_HEADCOUNT, DEFAULT_TRANSITIONS, IMPROVE_TIME_SHARE, NO_NIGHT_SHIFTS, \
+    RULE_LIMITS, SHIFT_DAY, SHIFT_EARLY, SHIFT_LATE, SHIFT_NIGHT, SHIFT_OFF, SHIFT_PAID, STAT_PHASES, STAT_RULES, \
+    ExactSolver, GenerationJob, GenerationStats, ResultCache, ScheduleGenerator, WorkerBudget
+from store import HISTORY_MONTHS, RosterStore
 
 # --- Streamlit UI ---
 
@@ -466,6 +39,8 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # Init Session State
+# The staff list a ward starts with the first time it is opened; after that
+# staff, requests and rosters come from the roster store
 if 'staff_list' not in st.session_state:
     st.session_state.staff_list = [
         {'id': 1, 'name': "神田", 'allowed_shifts': NO_NIGHT_SHIFTS, 'requests': {}},
@@ -479,22 +54,195 @@ if 'staff_list' not in st.session_state:
         {'id': 9, 'name': "秋本", 'allowed_shifts': ALL_SHIFTS, 'requests': {}}
     ]
 
-# Force strict sanitization of session state on every rerun
-# This fixes the issue where "None" string persists in the data
-for staff in st.session_state.staff_list:
-    if 'requests' in staff:
-        for dh in list(staff['requests'].keys()):
-            val = staff['requests'][dh]
-            if val is None or str(val) == "None":
-                del staff['requests'][dh]
+# Requests of the open month as a staff x day grid ("" where none), one row
+# per staff in list order (see load_month). It is what the request editor
+# shows; edits are patched in from the editor's delta, written to the store
+# and become each staff's 'requests' only when a roster is made.
+REQUEST_DAYS = [str(d) for d in range(1, 32)]
+DEFAULT_WARD = "病棟A"
+# The (ward, year, month) whose staff and requests are loaded
+if 'loaded_ward' not in st.session_state:
+    st.session_state.loaded_ward = None
+    st.session_state.loaded_month = None
 
 if 'generated_schedule' not in st.session_state:
     st.session_state.generated_schedule = None
+if 'generation_stats' not in st.session_state:
+    st.session_state.generation_stats = None
+# The last generated roster with the inputs it was made from, kept across
+# リセット so small request edits can be repaired instead of regenerated
+if 'base_schedule' not in st.session_state:
+    st.session_state.base_schedule = None
+# The running background generation (GenerationJob plus what is needed to
+# show and store its result), or None
+if 'generation_job' not in st.session_state:
+    st.session_state.generation_job = None
+
+
+@st.cache_resource
+def get_roster_store():
+    # One SQLite file for every session; SHIFT_APP_STORE sets its path
+    return RosterStore(os.environ.get('SHIFT_APP_STORE', 'shift_app.db'))
+
+
+def load_month(ward, year, month):
+    # Staff of the ward (a new ward keeps the list on screen) and the month's
+    # stored requests. A roster on screen belongs to the previous month.
+    store = get_roster_store()
+    if st.session_state.loaded_ward != ward:
+        staff_list = store.load_staff(ward)
+        if staff_list:
+            st.session_state.staff_list = staff_list
+        else:
+            store.save_staff(ward, st.session_state.staff_list)
+        st.session_state.loaded_ward = ward
+        # The staff widgets are keyed by staff id, and ids repeat across
+        # wards; their values from the previous ward must not carry over
+        for key in [key for key in st.session_state if key.startswith(("allow_", "del_"))]:
+            del st.session_state[key]
+    st.session_state.generated_schedule = None
+    st.session_state.generation_stats = None
+    requests = store.load_requests(ward, year, month)
+    st.session_state.request_grid = pd.DataFrame(
+        [[requests.get(staff['id'], {}).get(d, "") for d in REQUEST_DAYS] for staff in st.session_state.staff_list],
+        index=[staff['id'] for staff in st.session_state.staff_list], columns=REQUEST_DAYS, dtype=object
+    )
+    st.session_state.loaded_month = (ward, year, month)
+    # Edits of the previous month's editor must not be replayed onto this one
+    for key in [key for key in st.session_state if key.startswith("request_editor")]:
+        del st.session_state[key]
+
+
+def request_editor_key():
+    # One editor per ward and month: the browser keeps an editor's edited cells
+    # for as long as its key and shape stay the same
+    ward, year, month = st.session_state.loaded_month
+    return f"request_editor_{ward}_{year}_{month}"
+
+
+def apply_request_edits(key):
+    # on_change of the request editor: its edited cells (all of them since the
+    # editor was created, so applying one twice is harmless) go into the grid,
+    # and the edited staff's rows of the month into the store in one write.
+    # A cleared cell comes back as None
+    grid = st.session_state.request_grid
+    edited = set()
+    for row, cells in st.session_state[key]['edited_rows'].items():
+        staff_id = grid.index[row]
+        edited.add(staff_id)
+        for day, value in cells.items():
+            grid.at[staff_id, day] = "" if value is None or value == "None" else value
+    requests = {int(staff_id): {day: shift for day, shift in grid.loc[staff_id].items() if shift}
+                for staff_id in edited}
+    get_roster_store().save_request_rows(*st.session_state.loaded_month, requests)
+
+
+def store_requests(staff_list, days):
+    # Each staff's 'requests' ({"day": shift}) from the grid, for this month's days
+    day_cols = [str(d) for d in days]
+    for staff, row in zip(staff_list, st.session_state.request_grid[day_cols].to_numpy()):
+        staff['requests'] = {day: shift for day, shift in zip(day_cols, row) if shift}
+
+
+def allowed_shifts_of(staff_list):
+    return [sorted(s['allowed_shifts']) for s in staff_list]
+
+
+def remember_base(config, schedule, engine):
+    # Besides the requests, the inputs a repair cannot change: it is only
+    # offered while these still match (see repairable below)
+    get_roster_store().save_roster(config['ward'], config['year'], config['month'], schedule)
+    st.session_state.base_schedule = {
+        'ward': config['ward'],
+        'year': config['year'],
+        'month': config['month'],
+        'staff_ids': [s['id'] for s in config['staff_list']],
+        'allowed_shifts': allowed_shifts_of(config['staff_list']),
+        'rules': copy.deepcopy(config['rules']),
+        'engine': engine,
+        'requests': {s['id']: dict(s.get('requests', {})) for s in config['staff_list']},
+        'history': config.get('history'),
+        'schedule': schedule,
+    }
+
+
+@st.cache_resource
+def get_result_cache():
+    # Shared by all sessions of this server, so a refresh or another tab with
+    # the same inputs gets the stored roster. SHIFT_APP_CACHE_DIR adds a disk tier.
+    return ResultCache(cache_dir=os.environ.get('SHIFT_APP_CACHE_DIR'))
+
+
+@st.cache_resource
+def get_worker_budget():
+    # The CPUs of this server, split among the searches running at once
+    return WorkerBudget(os.cpu_count() or 1)
+
+
+def show_capacity_report(report):
+    if report['lower_bound'] > 0:
+        st.warning(f"人員が足りないため、最低 {report['lower_bound']} 件の不足が避けられません")
+        with st.expander("不足の内訳"):
+            st.markdown("\n".join(f"- {b['message']}" for b in report['bottlenecks']))
+
+
+def apply_generation_result(config, result, engine, stats=None, cancelled=False):
+    st.session_state.generation_stats = stats.to_dict() if stats else None
+    if result['success']:
+        st.session_state.generated_schedule = result['schedule']
+        remember_base(config, result['schedule'], engine)
+        if cancelled:
+            st.warning(f"中止しました（ここまでの最良案：不足 {result['deficit']} 件）")
+        elif result['deficit'] > 0:
+            st.warning(f"作成完了（不足 {result['deficit']} 件の最良案）")
+        else:
+            st.success("作成完了！")
+    else:
+        st.error("作成失敗：条件を満たすシフトが見つかりませんでした。")
+
+
+@st.fragment(run_every=0.5)
+def show_generation_job():
+    # Polls the background job; only this fragment reruns while it searches,
+    # and a full rerun picks up the result once the job has finished
+    job = st.session_state.generation_job['job']
+    if not job.running:
+        st.rerun()
+    progress = job.snapshot()
+    time_budget = st.session_state.generation_job['time_budget']
+    if progress['cancelling']:
+        text = "中止しています..."
+    elif progress['deficit'] is None:
+        text = "生成中..."
+    else:
+        text = f"試行 {progress['attempts']} 回 / 不足 {progress['deficit']}"
+    st.progress(min(1.0, progress['elapsed'] / time_budget), text=text)
+    if st.button("中止", disabled=progress['cancelling'], help="探索を止めて、ここまでの最良案を表示します"):
+        job.cancel()
+
+
+STAT_PHASE_LABELS = {
+    'prefill': "希望の反映", 'sort': "候補の順位付け", 'assign': "候補の制約チェック", 'analyze': "人員の事前チェック",
+    'holidays': "公休の調整", 'day_target': "日勤回数の調整", 'early_late': "早番・遅番の補充", 'improve': "局所探索",
+}
+STAT_RULE_LABELS = {
+    'streak': "連続勤務の上限", 'forbidden_transition': "禁止された翌日の組み合わせ（日勤の連続など）",
+    'day_cap': "日勤の月間上限に到達", 'night_cap': "夜勤の月間上限に到達", 'night_next_day': "夜勤翌日に予定あり",
+    'avoided_transition': "避けたい翌日の組み合わせ（遅番→早番など）", 'capacity_skip': "夜勤・日勤の残り枠不足で見送り",
+}
+RULE_LIMIT_LABELS = {
+    'max_consecutive_work_days': "連続勤務の上限（日）", 'monthly_public_off_days': "月の公休（日）",
+    'max_night_shifts': "夜勤の月間上限（回）", 'max_day_shifts': "日勤の月間回数（回）",
+}
 
 # Sidebar
 with st.sidebar:
     st.title("勤務表自動作成")
     
+    st.header("病棟")
+    ward = st.text_input("病棟名", value=DEFAULT_WARD, label_visibility="collapsed",
+                         help="病棟ごとにスタッフ・希望・作成した勤務表を保存します").strip() or DEFAULT_WARD
+
     st.header("期間設定")
     col_y, col_m = st.columns([1, 1])
     year = col_y.number_input("年", value=2026, step=1, label_visibility="collapsed")
@@ -503,10 +251,13 @@ with st.sidebar:
     # Update days based on sidebar input
     days_in_month = calendar.monthrange(year, month)[1]
     days = list(range(1, days_in_month + 1))
+    if st.session_state.loaded_month != (ward, year, month):
+        load_month(ward, year, month)
 
     st.header("スタッフ管理")
     
     # Staff List - Compact View
+    staff_changed = False
     for i, staff in enumerate(st.session_state.staff_list):
         c1, c2 = st.columns([3, 1])
         with c1:
@@ -518,43 +269,179 @@ with st.sidebar:
                     default=staff['allowed_shifts'],
                     key=f"allow_{staff['id']}"
                 )
+                staff_changed = staff_changed or allowed != staff['allowed_shifts']
                 staff['allowed_shifts'] = allowed
         with c2:
              if st.button("✕", key=f"del_{staff['id']}", help="削除"):
                 st.session_state.staff_list.pop(i)
+                st.session_state.request_grid = st.session_state.request_grid.drop(index=staff['id'])
+                get_roster_store().save_staff(ward, st.session_state.staff_list)
                 st.rerun()
+    if staff_changed:
+        get_roster_store().save_staff(ward, st.session_state.staff_list)
 
     new_name = st.text_input("新規スタッフ名", placeholder="名前を入力")
     if st.button("スタッフ追加"):
         if new_name:
+            staff_id = int(time.time() * 1000)
             st.session_state.staff_list.append({
-                'id': int(time.time() * 1000),
+                'id': staff_id,
                 'name': new_name,
                 'allowed_shifts': ALL_SHIFTS.copy(),
                 'requests': {}
             })
+            st.session_state.request_grid.loc[staff_id] = ""
+            get_roster_store().save_staff(ward, st.session_state.staff_list)
             st.rerun()
 
+    # Ward rules, passed to the engine as config['rules'] (defaults left out)
+    with st.expander("勤務ルール"):
+        rules = {}
+        for key, default in RULE_LIMITS.items():
+            value = st.number_input(RULE_LIMIT_LABELS[key], min_value=0, max_value=days_in_month, value=default,
+                                    step=1, key=f"rule_{key}")
+            if value != default:
+                rules[key] = value
+        weekend = st.columns(len(DEFAULT_HEADCOUNT))
+        weekend_headcount = {}
+        for col, (shift, count) in zip(weekend, DEFAULT_HEADCOUNT.items()):
+            value = col.number_input(f"土日の{shift}", min_value=0, value=count, step=1, key=f"weekend_{shift}")
+            if value != count:
+                weekend_headcount[shift] = value
+        if weekend_headcount:
+            rules['weekday_headcount'] = {5: weekend_headcount, 6: weekend_headcount}
+        if st.checkbox("遅番→早番を禁止する", value=False,
+                       help="オフのときは、ほかに担当者がいない場合に限り遅番の翌日に早番を入れます"):
+            rules['transitions'] = [(prev, code, 'forbid' if (prev, code) == (SHIFT_LATE, SHIFT_EARLY) else kind)
+                                    for prev, code, kind in DEFAULT_TRANSITIONS]
+
     st.markdown("---")
     st.header("アクション")
-    if st.button("勤務表を作成", type="primary"):
+    engine = st.radio("作成方法", ["ランダム探索", "遺伝的探索", "厳密解法"], horizontal=True,
+                      help="遺伝的探索はよい案同士を組み合わせて改良し、人員に余裕のない病棟で不足を減らします。"
+                           "厳密解法は不足ゼロの勤務表を探し、存在しない場合はその理由を表示します")
+    time_budget = st.number_input("計算時間（秒）", min_value=1, value=10, step=5)
+    use_local_search = st.checkbox("局所探索で仕上げる", value=True, disabled=engine == "厳密解法")
+    collect_stats = st.checkbox("統計を記録", value=False, disabled=engine == "厳密解法",
+                                help="各処理の時間と、候補が除外された理由ごとの件数を記録します")
+    seed = st.number_input("乱数シード", min_value=0, value=0, step=1,
+                           help="同じ入力とシードなら前回の結果をすぐに表示します。別の案を見るにはシードを変えてください")
+    base = st.session_state.base_schedule
+    # Staff ids are only unique within a ward
+    same_staff = (base is not None and base['ward'] == ward
+                  and base['staff_ids'] == [s['id'] for s in st.session_state.staff_list])
+    same_month = same_staff and (base['year'], base['month']) == (year, month)
+    previous_month = (year, month - 1) if month > 1 else (year - 1, 12)
+    previous_roster = get_roster_store().load_roster(ward, *previous_month)
+    use_carry = previous_roster is not None and st.checkbox(
+        "前月末の勤務を引き継ぐ", value=True,
+        help="前月の勤務表の月末の夜勤・明けや連勤を、1日目からの勤務に反映します"
+    )
+    # A repair only redoes the days around request edits, so any other change
+    # to the inputs, or another engine, needs a full generation
+    repairable = (same_month and st.session_state.generated_schedule is None
+                  and base['allowed_shifts'] == allowed_shifts_of(st.session_state.staff_list)
+                  and base['rules'] == rules and base['engine'] == engine)
+    use_repair = repairable and st.checkbox(
+        "前回の勤務表を修正して作成", value=True,
+        help="希望を変えた日の前後だけを作り直し、それ以外のシフトはそのまま残します"
+    )
+    config = None
+    if st.button("勤務表を作成", type="primary", disabled=st.session_state.generation_job is not None):
+        # A copy, so request edits made while a background search runs do not
+        # leak into it
+        store_requests(st.session_state.staff_list, days)
         config = {
+            'ward': ward,
             'year': year,
             'month': month,
-            'staff_list': st.session_state.staff_list
+            'staff_list': copy.deepcopy(st.session_state.staff_list),
+            'rules': rules,
         }
-        with st.spinner("生成中..."):
-            generator = ScheduleGenerator(config)
-            result = generator.generate()
-            if result['success']:
-                st.session_state.generated_schedule = result['schedule']
-                st.success("作成完了！")
+        # Last month's final days, taken from its stored roster or kept from
+        # the earlier run of this month
+        if use_carry:
+            config['history'] = ScheduleGenerator.carry_over(previous_roster)
+        elif same_month and base.get('history'):
+            config['history'] = base['history']
+    result_cache = get_result_cache()
+    if config and use_repair:
+        result = ScheduleGenerator(config, seed=seed).repair(base['schedule'], base['requests'])
+        st.session_state.generated_schedule = result['schedule']
+        st.session_state.generation_stats = None
+        remember_base(config, result['schedule'], base['engine'])
+        message = f"修正完了（{len(result['repaired_days'])} 日分を見直し、{result['changed_cells']} 件を変更）"
+        if result['deficit'] > 0:
+            st.warning(f"{message}：不足 {result['deficit']} 件")
+        else:
+            st.success(message)
+    elif config and engine == "厳密解法":
+        cache_key = ResultCache.key(config, {'engine': 'exact', 'seed': seed, 'time_limit': time_budget})
+        result = result_cache.get(cache_key)
+        if result is not None:
+            st.info("同じ条件で作成済みの結果を表示しています")
+        else:
+            with st.spinner("厳密解法で探索中..."):
+                result = ExactSolver(config, seed=seed).solve(time_limit=time_budget)
+            result_cache.put(cache_key, result)
+        if result['status'] == 'optimal':
+            st.session_state.generated_schedule = result['schedule']
+            remember_base(config, result['schedule'], engine)
+            st.success("作成完了！（全条件を満たしています）")
+        elif result['status'] == 'infeasible':
+            st.error(f"条件を満たす勤務表は存在しません：{result['reason']}")
+            if result.get('bottlenecks'):
+                with st.expander("不足の内訳"):
+                    st.markdown("\n".join(f"- {b['message']}" for b in result['bottlenecks']))
+        else:
+            st.warning("制限時間内に解が見つかりませんでした。計算時間を延ばすかランダム探索をお試しください。")
+    elif config:
+        stats = GenerationStats() if collect_stats else None
+        generator = ScheduleGenerator(config, seed=seed, stats=stats)
+        # Counting check first: an impossible roster is explained right away and
+        # the search stops as soon as it reaches the unavoidable shortage
+        report = generator.analyze_capacity()
+        # Local search gets the last part of the budget
+        improve_time = time_budget * IMPROVE_TIME_SHARE if use_local_search else 0
+        evolve = engine == "遺伝的探索"
+        cache_key = ResultCache.key(config, {'engine': 'genetic' if evolve else 'random', 'seed': seed,
+                                             'time_budget': time_budget, 'improve_time': improve_time})
+        # Recording stats needs a real run
+        result = None if stats else result_cache.get(cache_key)
+        if result is not None:
+            show_capacity_report(report)
+            st.info("同じ条件で作成済みの勤務表を表示しています")
+            apply_generation_result(config, result, engine)
+        else:
+            # The search runs in the background; the page keeps rerunning and
+            # polls it below until it finishes or is cancelled
+            job = GenerationJob(generator, budget=get_worker_budget(), time_budget=time_budget - improve_time,
+                                evolve=evolve, workers=os.cpu_count() or 1, improve_time=improve_time).start()
+            st.session_state.generation_job = {'job': job, 'config': config, 'cache_key': cache_key,
+                                               'stats': stats, 'report': report, 'time_budget': time_budget,
+                                               'engine': engine}
+
+    job_state = st.session_state.generation_job
+    if job_state is not None:
+        show_capacity_report(job_state['report'])
+        job = job_state['job']
+        if job.running:
+            show_generation_job()
+        else:
+            st.session_state.generation_job = None
+            if job.status == 'error':
+                st.error(f"作成中にエラーが発生しました：{job.error}")
             else:
-                st.error("作成失敗：条件を満たすシフトが見つかりませんでした。")
-    
+                # A cancelled run is not the result of its options, so it is not cached
+                if job.status == 'done':
+                    result_cache.put(job_state['cache_key'], job.result)
+                apply_generation_result(job_state['config'], job.result, job_state['engine'], job_state['stats'],
+                                        cancelled=job.status == 'cancelled')
+
     if st.session_state.generated_schedule:
         if st.button("リセット"):
             st.session_state.generated_schedule = None
+            st.session_state.generation_stats = None
             st.rerun()
 
 # --- Main Area ---
@@ -564,23 +451,9 @@ st.caption("セルをクリックしてシフトを選択してください。
 
 # Build DataFrame for editing (Requests mode)
 if st.session_state.generated_schedule is None:
-    # Show editable request table
-    data = {}
-    
-    # Pre-populate data with sanitized values
-    for d in days:
-        col_data = []
-        for staff in st.session_state.staff_list:
-            val = staff['requests'].get(str(d), "")
-            # Strict sanitization
-            if val is None or str(val) == "None":
-                val = ""
-            col_data.append(val)
-        data[str(d)] = col_data
-    
-    # Create DF with "氏名" as index
+    # Show editable request table: the grid's days of this month, named rows
     staff_names = [s['name'] for s in st.session_state.staff_list]
-    df_edit = pd.DataFrame(data, index=staff_names)
+    df_edit = st.session_state.request_grid[[str(d) for d in days]].set_axis(staff_names)
     
     # Column config for dropdown
     shift_options = ["", SHIFT_OFF, SHIFT_PAID, SHIFT_EARLY, SHIFT_DAY, SHIFT_LATE, SHIFT_NIGHT]
@@ -597,63 +470,57 @@ if st.session_state.generated_schedule is None:
             width="small"
         )
     
-    edited_df = st.data_editor(
+    # Edits reach the grid through apply_request_edits, not the return value
+    editor_key = request_editor_key()
+    st.data_editor(
         df_edit,
         column_config=column_config,
         use_container_width=True,
-        key="request_editor",
-        num_rows="fixed"
+        key=editor_key,
+        num_rows="fixed",
+        on_change=apply_request_edits,
+        args=(editor_key,)
     )
-    
-    # Sync edits back to session state
-    for i, name in enumerate(staff_names):
-        # Find staff by name (index) - assuming unique names or using index mapping
-        staff = st.session_state.staff_list[i]
-        new_requests = {}
-        for d in days:
-            val = edited_df.iloc[i][str(d)]
-            if val is not None and str(val) != "" and str(val) != "None":
-                new_requests[str(d)] = val
-        staff['requests'] = new_requests
+
+    # Nights per person over the stored rosters of the past year, to spread
+    # the night shifts when entering requests
+    night_counts = get_roster_store().shift_counts(ward, SHIFT_NIGHT, year, month)
+    if night_counts:
+        with st.expander(f"過去{HISTORY_MONTHS}か月の夜勤回数"):
+            st.dataframe(pd.DataFrame([[night_counts.get(s['id'], 0) for s in st.session_state.staff_list]],
+                                      columns=staff_names, index=["夜勤"]), use_container_width=True)
 
 else:
     # Generated schedule view (read-only)
     st.subheader("勤務表（生成済み）")
     
-    data = []
-    headers = [str(d) for d in days]
-    
-    for staff in st.session_state.staff_list:
-        row = [staff['name']]
-        for d in days:
-            val = st.session_state.generated_schedule[staff['id']][d]
-            row.append(val if val else "")
-        data.append(row)
-    
-    df = pd.DataFrame(data, columns=["氏名"] + headers)
+    # Every table below comes from one analytics frame of the roster, checked
+    # against the ward rules set in the sidebar and the carried-over days
+    base = st.session_state.base_schedule
+    analytics = RosterAnalytics({
+        'year': year,
+        'month': month,
+        'staff_list': st.session_state.staff_list,
+        'rules': rules,
+        'history': base['history'] if base and (base['ward'], base['year'], base['month']) == (ward, year, month)
+        else None,
+    }, st.session_state.generated_schedule)
+    df = analytics.table()
     st.dataframe(df, use_container_width=True)
 
-    # Help Needed Row
+    # Help Needed Row: every shift type against its actual headcount
     st.caption("不足人員")
-    help_row = []
-    
-    for d in days:
-        cnt_day = 0
-        cnt_night = 0
-        for staff in st.session_state.staff_list:
-             s = st.session_state.generated_schedule[staff['id']][d]
-             if s == SHIFT_DAY: cnt_day += 1
-             if s == SHIFT_NIGHT: cnt_night += 1
-        
-        alerts = []
-        if cnt_day < DEFAULT_HEADCOUNT[SHIFT_DAY]: alerts.append("日")
-        if cnt_night < DEFAULT_HEADCOUNT[SHIFT_NIGHT]: alerts.append("夜")
-        
-        help_row.append("/".join(alerts) if alerts else "")
-
-    df_help = pd.DataFrame([help_row], columns=headers, index=["不足"])
+    shortage = analytics.shortage()
+    df_help = pd.DataFrame([analytics.shortage_labels(shortage).to_numpy()], columns=df.columns[1:], index=["不足"])
     st.dataframe(df_help, use_container_width=True)
 
+    quality = analytics.quality(shortage)
+    st.caption(f"不足 {quality['shortage']} 件 ・ 連勤超過 {quality['streak_violations']} 件 ・ "
+               f"避けたい並び {quality['avoided_transitions']} 件 ・ 禁止の並び {quality['forbidden_transitions']} 件 ・ "
+               f"夜勤回数の差 {quality['night_spread']} 回")
+    with st.expander("スタッフ別集計"):
+        st.dataframe(analytics.staff_totals(), use_container_width=True)
+
     # CSV Download
     csv = df.to_csv(index=False).encode('utf-8-sig')
     st.download_button(
@@ -664,3 +531,21 @@ else:
         key='download-csv',
         type="primary"
     )
+
+    if st.session_state.generation_stats:
+        gen_stats = st.session_state.generation_stats
+        with st.expander("生成の統計"):
+            deficits = [d for d in gen_stats['deficits'] if d != float('inf')]
+            st.caption(f"試行 {len(gen_stats['deficits'])} 回（うち打ち切り {len(gen_stats['deficits']) - len(deficits)} 回）")
+            col_phase, col_rule = st.columns(2)
+            col_phase.dataframe(pd.DataFrame(
+                {"秒": [round(gen_stats['phase_time'][p], 3) for p in STAT_PHASES]},
+                index=[STAT_PHASE_LABELS[p] for p in STAT_PHASES]
+            ), use_container_width=True)
+            col_rule.dataframe(pd.DataFrame(
+                {"除外件数": [gen_stats['rejections'][r] for r in STAT_RULES]},
+                index=[STAT_RULE_LABELS[r] for r in STAT_RULES]
+            ).sort_values("除外件数", ascending=False), use_container_width=True)
+            if deficits:
+                st.caption("試行ごとの不足数")
+                st.line_chart(pd.DataFrame({"不足": deficits}))
@@ -0,0 +1,298 @@
+# Batch generation without the UI: every ward file for every month in one run.
+#
+#   python batch.py wards/ --month 2026-02 --month 2026-03 -o out --workers 8
+#   python batch.py ward_a.csv ward_b.json --month 2026-04 --attempts 500
+#
+# A JSON file holds one config as used by the app ({'staff_list', 'headcount',
+# 'year', 'month'}) or a list of them, each with an optional 'ward' name;
+# configs without year/month are run for every --month. A CSV file is one ward
+# with the header  id,name,allowed_shifts,1,2,...,31  where allowed_shifts is
+# e.g. "早日遅" (empty = all shifts) and the day columns hold requests.
+# JSON configs may also carry 'history' (last month's final days per staff id,
+# see ScheduleGenerator.carry_over) and 'template' (an earlier roster for the
+# same staff, used as a warm start), 'rules' (ward limits, per-weekday and
+# per-date headcount and next-day rules, see RuleSet) and per staff 'limits'.
+# Each roster is written by its worker as <ward>_<year>_<month>.csv in the
+# app's download format as soon as it is done, and a row per roster is
+# appended to summary.csv (shortage per shift and the short days). Wards are
+# read lazily and only a few are in flight, so memory does not grow with the
+# number of wards. Only the engine module is imported, so start-up stays fast.
+# With --store, each worker also saves the ward's staff, the month's requests
+# and the roster to that SQLite roster store (see store.py), as the app does.
+
+import argparse
+import calendar
+import csv
+import json
+import os
+import sys
+import time
+
+from scheduler import ALL_SHIFTS, IMPROVE_TIME_SHARE, SHIFT_CODES, ScheduleGenerator
+
+REQUEST_SHIFTS = set(SHIFT_CODES) - {None}
+
+
+def parse_month(text):
+    try:
+        year, month = (int(part) for part in text.split('-'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected YYYY-MM, got {text!r}")
+    if not 1 <= month <= 12:
+        raise argparse.ArgumentTypeError(f"no such month: {text!r}")
+    return year, month
+
+
+def read_json_wards(path):
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    configs = data if isinstance(data, list) else [data]
+    stem = os.path.splitext(os.path.basename(path))[0]
+    wards = []
+    for n, config in enumerate(configs):
+        if not isinstance(config, dict) or not isinstance(config.get('staff_list'), list):
+            raise ValueError("each ward needs a 'staff_list'")
+        name = config.get('ward') or (stem if len(configs) == 1 else f"{stem}{n + 1}")
+        wards.append((name, config))
+    return wards
+
+
+def read_csv_ward(path):
+    staff_list = []
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            allowed = [shift for shift in ALL_SHIFTS if shift in (row.get('allowed_shifts') or '')]
+            requests = {}
+            for column, value in row.items():
+                value = (value or '').strip()
+                if column and column.isdigit() and value:
+                    requests[str(int(column))] = value
+            staff_list.append({
+                'id': int(row['id']) if row.get('id') else reader.line_num - 1,
+                'name': row.get('name') or f"スタッフ{reader.line_num - 1}",
+                'allowed_shifts': allowed or ALL_SHIFTS.copy(),
+                'requests': requests,
+            })
+    return [(os.path.splitext(os.path.basename(path))[0], {'staff_list': staff_list})]
+
+
+def validate(config):
+    ids = [staff['id'] for staff in config['staff_list']]
+    if len(set(ids)) != len(ids):
+        raise ValueError("staff ids must be unique")
+    for staff in config['staff_list']:
+        for day, shift in staff.get('requests', {}).items():
+            if shift not in REQUEST_SHIFTS:
+                raise ValueError(f"{staff.get('name', staff['id'])}: unknown request {shift!r} on day {day}")
+
+
+def month_config(config, year, month):
+    # A ward file can serve several months; drop requests past this month's end
+    days_in_month = calendar.monthrange(year, month)[1]
+    staff_list = [
+        dict(staff, requests={day: shift for day, shift in staff.get('requests', {}).items()
+                              if int(day) <= days_in_month})
+        for staff in config['staff_list']
+    ]
+    return dict(config, year=year, month=month, staff_list=staff_list)
+
+
+def iter_ward_files(inputs):
+    # Directories are scanned (sorted, not recursive) for .json/.csv ward files
+    for path in inputs:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(('.json', '.csv')):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def iter_jobs(inputs, months):
+    # One job per ward and month, read lazily so only the wards in flight are
+    # held in memory; a config's own year/month wins over --month. Unreadable
+    # files yield an {'error'} job instead of stopping the run.
+    for path in iter_ward_files(inputs):
+        try:
+            wards = read_csv_ward(path) if path.lower().endswith('.csv') else read_json_wards(path)
+            for ward, config in wards:
+                validate(config)
+                if not months and ('year' not in config or 'month' not in config):
+                    raise ValueError(f"{ward}: no year/month in the file; pass --month")
+        except (OSError, ValueError, KeyError) as e:
+            yield {'ward': path, 'error': str(e)}
+            continue
+        for ward, config in wards:
+            ward_months = [(config['year'], config['month'])] if 'year' in config and 'month' in config else months
+            for year, month in ward_months:
+                yield {'ward': ward, 'config': month_config(config, year, month)}
+
+
+def run_job(job, options):
+    # Runs in a pool worker: generates, writes the roster CSV and returns only
+    # the summary row, so finished rosters never pile up in the main process
+    config = job['config']
+    summary = {'ward': job['ward'], 'year': config['year'], 'month': config['month'],
+               'staff': len(config['staff_list'])}
+    started = time.perf_counter()
+    try:
+        generator = ScheduleGenerator(config, seed=options['seed'])
+        result = generator.generate(max_retries=options['attempts'], time_budget=options['time_budget'],
+                                    improve_time=options['improve_time'], evolve=options['evolve'])
+        if result['success']:
+            path = os.path.join(options['output_dir'],
+                                f"{job['ward']}_{config['year']}_{config['month']:02d}.csv")
+            write_schedule(path, config, result['schedule'])
+            if options['store']:
+                save_to_store(options['store'], job['ward'], config, result['schedule'])
+            report = generator.shortage_report(generator.to_matrix(result['schedule']))
+            summary.update(status='ok', path=path, attempts=result['attempts'], shortage=report)
+        else:
+            summary.update(status='failed', attempts=result.get('attempts', 0))
+    except Exception as e:
+        summary.update(status='error', error=f"{type(e).__name__}: {e}")
+    summary['seconds'] = time.perf_counter() - started
+    return summary
+
+
+def save_to_store(path, ward, config, schedule):
+    from store import RosterStore
+
+    store = RosterStore(path)
+    try:
+        store.save_staff(ward, config['staff_list'])
+        store.save_requests(ward, config['year'], config['month'], config['staff_list'])
+        store.save_roster(ward, config['year'], config['month'], schedule)
+    finally:
+        store.close()
+
+
+def error_summary(job):
+    return {'ward': job['ward'], 'status': 'error', 'error': job['error']}
+
+
+def run_pipeline(jobs, options, workers):
+    # Yields summaries in completion order. At most workers * 2 rosters are
+    # submitted ahead, so neither configs nor results accumulate.
+    if workers <= 1:
+        for job in jobs:
+            yield error_summary(job) if 'error' in job else run_job(job, options)
+        return
+
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+    pool = ProcessPoolExecutor(max_workers=workers)
+    pending = set()
+    try:
+        for job in jobs:
+            if 'error' in job:
+                yield error_summary(job)
+                continue
+            pending.add(pool.submit(run_job, job, options))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def write_schedule(path, config, schedule):
+    days = range(1, calendar.monthrange(config['year'], config['month'])[1] + 1)
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["氏名"] + [str(d) for d in days])
+        for staff in config['staff_list']:
+            row = schedule[staff['id']]
+            writer.writerow([staff['name']] + [row[d] or "" for d in days])
+
+
+SUMMARY_HEADER = ["病棟", "年", "月", "人数", "結果", "不足合計"] + ALL_SHIFTS + ["不足日", "試行", "秒", "ファイル"]
+STATUS_LABELS = {'ok': "作成", 'failed': "失敗", 'error': "エラー"}
+
+
+def summary_row(summary):
+    shortage = summary.get('shortage')
+    if shortage is None:
+        counts = [""] * (1 + len(ALL_SHIFTS))
+        short_days = summary.get('error', "")
+    else:
+        per_shift = [sum(shortage.get(shift, {}).values()) for shift in ALL_SHIFTS]
+        counts = [sum(per_shift)] + per_shift
+        # e.g. "3(夜) 12(早2,遅)"
+        by_day = {}
+        for shift in ALL_SHIFTS:
+            for day, missing in shortage.get(shift, {}).items():
+                by_day.setdefault(day, []).append(shift if missing == 1 else f"{shift}{missing}")
+        short_days = " ".join(f"{day}({','.join(shifts)})" for day, shifts in sorted(by_day.items()))
+    return ([summary['ward'], summary.get('year', ""), summary.get('month', ""), summary.get('staff', ""),
+             STATUS_LABELS[summary['status']]] + counts
+            + [short_days, summary.get('attempts', ""), round(summary.get('seconds', 0), 1),
+               summary.get('path', "")])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate shift schedules for many wards and months")
+    parser.add_argument('inputs', nargs='+', help="ward files (.json or .csv) or directories of them")
+    parser.add_argument('--month', dest='months', type=parse_month, action='append', default=[],
+                        metavar='YYYY-MM', help="month to generate; repeat for several")
+    parser.add_argument('-o', '--output-dir', default='.')
+    parser.add_argument('--summary', help="shortage summary CSV (default: OUTPUT_DIR/summary.csv)")
+    parser.add_argument('--time-budget', type=float, default=10, help="seconds per roster (default: 10)")
+    parser.add_argument('--attempts', type=int,
+                        help="fixed number of attempts instead of a time budget; "
+                             "with --seed and --no-local-search the output is reproducible")
+    parser.add_argument('--no-local-search', action='store_true')
+    parser.add_argument('--evolve', action='store_true',
+                        help="recombine the attempts with the genetic search (fewer shortages on tight wards)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1, help="rosters generated in parallel")
+    parser.add_argument('--store', metavar='DB', help="also save staff, requests and rosters to this SQLite store")
+    args = parser.parse_args()
+
+    budget = None if args.attempts else args.time_budget
+    improve_time = 0 if args.no_local_search else args.time_budget * IMPROVE_TIME_SHARE
+    options = {
+        'seed': args.seed,
+        'attempts': args.attempts,
+        'time_budget': None if budget is None else budget - improve_time,
+        'improve_time': improve_time,
+        'evolve': args.evolve,
+        'output_dir': args.output_dir,
+        'store': args.store,
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    summary_path = args.summary or os.path.join(args.output_dir, 'summary.csv')
+
+    total = failed = 0
+    with open(summary_path, 'w', encoding='utf-8-sig', newline='') as summary_file:
+        writer = csv.writer(summary_file)
+        writer.writerow(SUMMARY_HEADER)
+        for summary in run_pipeline(iter_jobs(args.inputs, args.months), options, args.workers):
+            total += 1
+            writer.writerow(summary_row(summary))
+            summary_file.flush()
+            if 'year' in summary:
+                label = f"{summary['ward']} {summary['year']}-{summary['month']:02d}"
+            else:
+                label = summary['ward']
+            if summary['status'] == 'ok':
+                shortage = sum(sum(days.values()) for days in summary['shortage'].values())
+                print(f"{label:<24} shortage {shortage:<4} attempts {summary['attempts']:<6} "
+                      f"{summary['seconds']:.1f}s -> {summary['path']}", flush=True)
+            else:
+                failed += 1
+                print(f"{label:<24} {summary['status']} {summary.get('error', '')}", flush=True)
+
+    print(f"\n{total - failed}/{total} rosters written to {args.output_dir}; summary in {summary_path}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
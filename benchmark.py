@@ -0,0 +1,183 @@
+# Benchmark for ScheduleGenerator: speed and roster quality on synthetic wards.
+#
+#   python benchmark.py                           # full grid -> benchmark.json
+#   python benchmark.py --sizes 9 30 --attempts 50 -o before.json
+#   python benchmark.py -o after.json --compare before.json
+#
+# Every case is seeded, so two revisions run on identical inputs and the same
+# attempt sequence; compare wall time and attempts/sec for speed and deficit /
+# shortage for quality.
+
+import argparse
+import calendar
+import json
+import platform
+import random
+import subprocess
+import time
+from datetime import datetime
+
+from scheduler import ALL_SHIFTS, NO_NIGHT_SHIFTS, SHIFT_DAY, SHIFT_EARLY, SHIFT_LATE, SHIFT_NIGHT, SHIFT_OFF, \
+    SHIFT_PAID, ScheduleGenerator
+
+DEFAULT_SIZES = [9, 30, 100, 300]
+DEFAULT_DENSITIES = [0.0, 0.2, 0.4]
+# One month of each length: 28, 29, 30 and 31 days
+DEFAULT_MONTHS = [(2026, 2), (2028, 2), (2026, 4), (2026, 1)]
+NIGHT_STAFF_RATIO = 0.5
+
+# Methods timed as phases: the capacity check, the greedy attempts, the rerun
+# of the best attempt that rebuilds its roster, the finalizer and the repair
+PHASES = {
+    'analyze': 'analyze_capacity',
+    'attempts': 'run_attempt',
+    'replay': 'best_schedule',
+    'finalize': 'finalize_matrix',
+    'improve': 'improve',
+}
+
+
+def make_config(n_staff, density, year, month, seed):
+    # Mixed night/no-night staff with random 公/有/shift requests on `density`
+    # of their days. Headcount scales with the ward so the monthly 日 cap stays
+    # satisfiable (one unit per 14 staff, the default for a small ward).
+    rng = random.Random(seed)
+    days_in_month = calendar.monthrange(year, month)[1]
+    staff_list = []
+    for i in range(n_staff):
+        allowed = ALL_SHIFTS.copy() if rng.random() < NIGHT_STAFF_RATIO else NO_NIGHT_SHIFTS.copy()
+        requests = {}
+        for d in range(1, days_in_month + 1):
+            if rng.random() < density:
+                requests[str(d)] = rng.choice([SHIFT_OFF, SHIFT_OFF, SHIFT_PAID, rng.choice(allowed)])
+        staff_list.append({'id': i + 1, 'name': f"スタッフ{i + 1}", 'allowed_shifts': allowed, 'requests': requests})
+
+    unit = max(1, n_staff // 14)
+    headcount = {SHIFT_EARLY: 2 * unit, SHIFT_DAY: unit, SHIFT_LATE: 2 * unit, SHIFT_NIGHT: unit}
+    return {'year': year, 'month': month, 'staff_list': staff_list, 'headcount': headcount}
+
+
+def time_phases(generator):
+    # Wrap the phase methods on this instance to accumulate their wall time and
+    # keep what each returned last. A call made inside another phase (the
+    # replay's run_attempt) counts towards the outer phase only.
+    totals = {phase: 0.0 for phase in PHASES}
+    returned = {}
+    active = []
+
+    for phase, name in PHASES.items():
+        method = getattr(generator, name)
+
+        def timed(*args, _phase=phase, _method=method, **kwargs):
+            if active:
+                return _method(*args, **kwargs)
+            active.append(_phase)
+            start = time.perf_counter()
+            try:
+                returned[_phase] = _method(*args, **kwargs)
+                return returned[_phase]
+            finally:
+                totals[_phase] += time.perf_counter() - start
+                active.pop()
+
+        setattr(generator, name, timed)
+    return totals, returned
+
+
+def run_case(n_staff, density, year, month, seed, attempts, improve_time, evolve=False):
+    config = make_config(n_staff, density, year, month, seed)
+    generator = ScheduleGenerator(config, seed=seed)
+    phases, returned = time_phases(generator)
+
+    start = time.perf_counter()
+    result = generator.generate(max_retries=attempts, improve_time=improve_time, evolve=evolve)
+    wall = time.perf_counter() - start
+
+    shortage = None
+    if result['success']:
+        shortage = generator.coverage_shortage(generator.to_matrix(result['schedule']))
+    return {
+        'name': f"{n_staff}staff-{int(density * 100)}pct-{calendar.monthrange(year, month)[1]}d-seed{seed}",
+        'staff': n_staff,
+        'density': density,
+        'days': generator.days_in_month,
+        'seed': seed,
+        'attempts': result.get('attempts', 0),
+        'wall': round(wall, 4),
+        'attempts_per_sec': round(result.get('attempts', 0) / phases['attempts'], 1) if phases['attempts'] else None,
+        'lower_bound': returned['analyze']['lower_bound'],
+        'deficit': result.get('search_deficit'),
+        'shortage': shortage,
+        'phases': {phase: round(seconds, 4) for phase, seconds in phases.items()},
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(cases, baseline_path):
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {case['name']: case for case in json.load(f)['cases']}
+
+    print(f"\n{'case':<32}{'wall':>16}{'attempts/s':>20}{'shortage':>14}")
+    for case in cases:
+        old = baseline.get(case['name'])
+        if old is None:
+            continue
+        speedup = old['wall'] / case['wall'] if case['wall'] else float('inf')
+        print(f"{case['name']:<32}{old['wall']:>7.2f}→{case['wall']:<6.2f}({speedup:.2f}x)"
+              f"{old['attempts_per_sec'] or 0:>9.0f}→{case['attempts_per_sec'] or 0:<8.0f}"
+              f"{old['shortage']!s:>6}→{case['shortage']!s:<6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ScheduleGenerator benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--densities', type=float, nargs='+', default=DEFAULT_DENSITIES)
+    parser.add_argument('--days', type=int, nargs='+', choices=[28, 29, 30, 31],
+                        help="month lengths to run (default: all four)")
+    parser.add_argument('--seeds', type=int, nargs='+', default=[1])
+    parser.add_argument('--attempts', type=int, default=30, help="greedy attempts per case")
+    parser.add_argument('--improve-time', type=float, default=0, help="local search seconds per case")
+    parser.add_argument('--evolve', action='store_true',
+                        help="genetic search; --attempts then counts greedy attempts and children together")
+    parser.add_argument('-o', '--output', default='benchmark.json')
+    parser.add_argument('--compare', metavar='JSON', help="earlier output to compare against")
+    args = parser.parse_args()
+
+    months = [(y, m) for y, m in DEFAULT_MONTHS
+              if args.days is None or calendar.monthrange(y, m)[1] in args.days]
+
+    cases = []
+    for n_staff in args.sizes:
+        for density in args.densities:
+            for year, month in months:
+                for seed in args.seeds:
+                    case = run_case(n_staff, density, year, month, seed, args.attempts, args.improve_time,
+                                    args.evolve)
+                    cases.append(case)
+                    print(f"{case['name']:<32} {case['wall']:>8.2f}s {case['attempts_per_sec'] or 0:>8.0f}/s "
+                          f"deficit {case['deficit']} (lower bound {case['lower_bound']}) "
+                          f"shortage {case['shortage']}", flush=True)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'revision': git_revision(),
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'settings': {'attempts': args.attempts, 'improve_time': args.improve_time, 'evolve': args.evolve},
+            'cases': cases,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"\n{len(cases)} cases written to {args.output}")
+
+    if args.compare:
+        compare(cases, args.compare)
+
+
+if __name__ == '__main__':
+    main()
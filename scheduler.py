@@ -0,0 +1,2361 @@
+# Shift schedule engine: generator, local search, exact solver, result cache
+# and background jobs. Imports only the standard library, so batch runs and
+# worker processes start without Streamlit or pandas; app.py is the UI on top.
+
+import os
+import math
+import random
+import calendar
+import time
+import threading
+import heapq
+import json
+from collections import OrderedDict
+from array import array
+from itertools import accumulate, compress
+
+# --- Constants ---
+SHIFT_EARLY = '早'
+SHIFT_DAY = '日'
+SHIFT_LATE = '遅'
+SHIFT_NIGHT = '夜'
+SHIFT_DAWN = '明'
+SHIFT_OFF = '公'
+SHIFT_PAID = '有'
+
+DEFAULT_HEADCOUNT = {
+    SHIFT_EARLY: 2,
+    SHIFT_DAY: 1,
+    SHIFT_LATE: 2,
+    SHIFT_NIGHT: 1
+}
+
+MAX_CONSECUTIVE_WORK_DAYS = 3
+MONTHLY_PUBLIC_OFF_DAYS = 9
+MAX_NIGHT_SHIFTS = 6
+MAX_DAY_SHIFTS = 2
+
+DEFAULT_MAX_RETRIES = 500
+# Share of a time budget given to LocalSearch after the random search
+IMPROVE_TIME_SHARE = 0.3
+# Final days of the previous month kept for day 1: its last shift (the
+# 夜→明→公 chain and next-day rules) and a work streak running into it. A week
+# covers any streak limit a ward is likely to set.
+CARRY_DAYS = 7
+# Heap offset that puts staff off the warm-start template behind those on it
+# (larger than any monthly shift total)
+TEMPLATE_PENALTY = 64
+# Days on either side of an edited request that repair() may change, beyond
+# the longest work streak allowed: covers the 夜→明→公 chain
+REPAIR_MARGIN = 2
+PARALLEL_BATCH_SIZE = 20
+
+ALL_SHIFTS = [SHIFT_EARLY, SHIFT_DAY, SHIFT_LATE, SHIFT_NIGHT]
+NO_NIGHT_SHIFTS = [SHIFT_EARLY, SHIFT_DAY, SHIFT_LATE]
+
+# Small integer codes used by ScheduleMatrix (0 = unassigned)
+SHIFT_CODES = [None, SHIFT_EARLY, SHIFT_DAY, SHIFT_LATE, SHIFT_NIGHT, SHIFT_DAWN, SHIFT_OFF, SHIFT_PAID]
+CODE_OF = {s: c for c, s in enumerate(SHIFT_CODES)}
+C_NONE, C_EARLY, C_DAY, C_LATE, C_NIGHT, C_DAWN, C_OFF, C_PAID = range(len(SHIFT_CODES))
+NUM_CODES = len(SHIFT_CODES)
+IS_WORK_CODE = [C_EARLY <= c <= C_DAWN for c in range(NUM_CODES)]
+
+# --- Rules ---
+
+# Next-day transition table entries: allowed, allowed only when nobody else
+# can take the shift, never
+T_OK, T_AVOID, T_FORBID = 0, 1, 2
+TRANSITION_KINDS = {'avoid': T_AVOID, 'forbid': T_FORBID}
+# Besides the built-in 夜→明→公 chain: no 日 two days running, and 遅→早 only
+# as a last resort
+DEFAULT_TRANSITIONS = [(SHIFT_DAY, SHIFT_DAY, 'forbid'), (SHIFT_LATE, SHIFT_EARLY, 'avoid')]
+# Limits a ward can set in config['rules'] and a staff member in 'limits'
+RULE_LIMITS = {
+    'max_consecutive_work_days': MAX_CONSECUTIVE_WORK_DAYS,
+    'monthly_public_off_days': MONTHLY_PUBLIC_OFF_DAYS,
+    'max_night_shifts': MAX_NIGHT_SHIFTS,
+    'max_day_shifts': MAX_DAY_SHIFTS,
+}
+RULE_TABLES = ('weekday_headcount', 'date_headcount', 'transitions')
+
+
+class RuleSet:
+    # Rules declared as data, compiled once per generator into flat tables so
+    # every check in the search is a single index. config['rules'] may hold
+    #   RULE_LIMITS keys                  ward limits (defaults: the constants)
+    #   'weekday_headcount': {5: {...}}   demand on a weekday (Monday = 0)
+    #   'date_headcount': {'24': {...}}   demand on a date, over the weekday's
+    #   'transitions': [[from, to, kind]] next-day rules, replacing the defaults
+    # and a staff member's 'limits' overrides the ward limits for them. A day's
+    # demand starts from config['headcount'] and the tables replace the
+    # shifts they name.
+    def __init__(self, config, year, month, days_in_month):
+        rules = config.get('rules') or {}
+        unknown = set(rules) - set(RULE_LIMITS) - set(RULE_TABLES)
+        if unknown:
+            raise ValueError(f"unknown rules: {', '.join(sorted(map(str, unknown)))}")
+        ward = {key: int(rules.get(key, default)) for key, default in RULE_LIMITS.items()}
+
+        # Per staff row
+        limits = []
+        for staff in config['staff_list']:
+            own = staff.get('limits') or {}
+            unknown = set(own) - set(RULE_LIMITS)
+            if unknown:
+                raise ValueError(f"{staff.get('name', staff['id'])}: unknown limits: {', '.join(sorted(unknown))}")
+            limits.append({key: int(own.get(key, value)) for key, value in ward.items()})
+        self.max_streak = [l['max_consecutive_work_days'] for l in limits]
+        self.off_days = [l['monthly_public_off_days'] for l in limits]
+        self.cap = [None] * NUM_CODES
+        self.cap[C_NIGHT] = [l['max_night_shifts'] for l in limits]
+        self.cap[C_DAY] = [l['max_day_shifts'] for l in limits]
+        self.longest_streak = max(self.max_streak, default=ward['max_consecutive_work_days'])
+
+        # Per day: demand[d] is {shift: count} over the shifts with any demand
+        # this month, need[d * NUM_CODES + code] the same as a flat array
+        base = config.get('headcount', DEFAULT_HEADCOUNT)
+        weekday = {int(k): v for k, v in (rules.get('weekday_headcount') or {}).items()}
+        dated = {int(k): v for k, v in (rules.get('date_headcount') or {}).items()}
+        days = []
+        for d in range(1, days_in_month + 1):
+            demand = dict(base)
+            demand.update(weekday.get(calendar.weekday(year, month, d), {}))
+            demand.update(dated.get(d, {}))
+            days.append(demand)
+        for demand in days:
+            unknown = set(demand) - set(ALL_SHIFTS)
+            if unknown:
+                raise ValueError(f"headcount for unknown shifts: {', '.join(sorted(unknown))}")
+        self.shifts = list(base) + [shift for shift in ALL_SHIFTS
+                                    if shift not in base and any(shift in demand for demand in days)]
+        self.codes = [CODE_OF[shift] for shift in self.shifts]
+        self.demand = [{shift: 0 for shift in self.shifts}]
+        self.demand += [{shift: int(demand.get(shift, 0)) for shift in self.shifts} for demand in days]
+        self.need = array('h', bytes(2 * NUM_CODES * (days_in_month + 1)))
+        for d, demand in enumerate(self.demand):
+            for shift, count in demand.items():
+                self.need[d * NUM_CODES + CODE_OF[shift]] = count
+        # Demand from each day to the month end, per code
+        self.need_from = [None] * NUM_CODES
+        for shift in self.shifts:
+            code = CODE_OF[shift]
+            suffix = [0] * (days_in_month + 2)
+            for d in range(days_in_month, 0, -1):
+                suffix[d] = suffix[d + 1] + self.need[d * NUM_CODES + code]
+            self.need_from[code] = suffix
+
+        # transition[prev * NUM_CODES + code]: T_OK, T_AVOID or T_FORBID
+        self.transition = bytearray(NUM_CODES * NUM_CODES)
+        for prev, code, kind in rules.get('transitions', DEFAULT_TRANSITIONS):
+            if prev not in CODE_OF or code not in CODE_OF or kind not in TRANSITION_KINDS:
+                raise ValueError(f"bad transition rule: {prev}→{code} ({kind})")
+            self.transition[CODE_OF[prev] * NUM_CODES + CODE_OF[code]] = TRANSITION_KINDS[kind]
+
+# --- Schedule Matrix ---
+
+class ScheduleMatrix:
+    # Staff x day grid of int8 shift codes. Cells are stored day-major so a
+    # day's column is one contiguous slice, while a staff row is a strided
+    # slice. set() keeps two count tables in sync: totals (staff x code) for
+    # monthly counts and coverage (day x code) for daily headcounts, which
+    # count() reads, so both are O(1).
+    def __init__(self, n_staff, days_in_month):
+        self.n_staff = n_staff
+        self.days_in_month = days_in_month
+        self.cells = array('b', bytes(n_staff * (days_in_month + 1)))
+        self.totals = array('h', [days_in_month, 0, 0, 0, 0, 0, 0, 0] * n_staff)
+        self.coverage = array('h', [n_staff, 0, 0, 0, 0, 0, 0, 0] * (days_in_month + 1))
+
+    def get(self, i, day):
+        return self.cells[day * self.n_staff + i]
+
+    def set(self, i, day, code):
+        k = day * self.n_staff + i
+        old = self.cells[k]
+        base = i * NUM_CODES
+        self.totals[base + old] -= 1
+        self.totals[base + code] += 1
+        base = day * NUM_CODES
+        self.coverage[base + old] -= 1
+        self.coverage[base + code] += 1
+        self.cells[k] = code
+
+    def total(self, i, code):
+        return self.totals[i * NUM_CODES + code]
+
+    def count(self, day, code):
+        # Staff on `code` that day
+        return self.coverage[day * NUM_CODES + code]
+
+    def totals_of(self, code):
+        # Monthly count of one shift code for every staff member, as one slice
+        return self.totals[code::NUM_CODES]
+
+    def column(self, day):
+        start = day * self.n_staff
+        return self.cells[start:start + self.n_staff]
+
+    def row(self, i):
+        # Index 0 is the unused day-0 slot, matching the dict-of-lists shape
+        return self.cells[i::self.n_staff]
+
+    def copy(self):
+        other = ScheduleMatrix.__new__(ScheduleMatrix)
+        other.n_staff = self.n_staff
+        other.days_in_month = self.days_in_month
+        other.cells = array('b', self.cells)
+        other.totals = array('h', self.totals)
+        other.coverage = array('h', self.coverage)
+        return other
+
+    def to_dict(self, staff_ids):
+        return {sid: [SHIFT_CODES[c] for c in self.row(i)] for i, sid in enumerate(staff_ids)}
+
+    @classmethod
+    def from_dict(cls, schedule, staff_ids, days_in_month):
+        matrix = cls(len(staff_ids), days_in_month)
+        for i, sid in enumerate(staff_ids):
+            row = schedule[sid]
+            for d in range(1, days_in_month + 1):
+                if row[d] is not None:
+                    matrix.set(i, d, CODE_OF[row[d]])
+        return matrix
+
+# --- Generation Stats ---
+
+# Timed phases: request pre-fill, candidate ordering (with the capacity skip),
+# the candidate scan, the capacity check, and the finalizer's holiday, Day
+# target and Early/Late passes
+STAT_PHASES = ('prefill', 'sort', 'assign', 'analyze', 'holidays', 'day_target', 'early_late', 'improve')
+# Reasons a candidate is turned down. day_cap/night_cap count staff leaving a
+# shift's queue on reaching the monthly cap; capacity_skip a slot left empty
+# on purpose.
+STAT_RULES = ('streak', 'forbidden_transition', 'day_cap', 'night_cap', 'night_next_day', 'avoided_transition',
+              'capacity_skip')
+
+
+class GenerationStats:
+    # Pass as ScheduleGenerator(stats=...) to collect phase times (seconds,
+    # summed over all attempts), candidate rejections per rule and every
+    # attempt's deficit (inf when branch and bound cut it short). on_attempt,
+    # if given, is called with (stats, deficit) after each attempt. Without a
+    # stats object the generator only pays for `is not None` checks.
+    def __init__(self, on_attempt=None):
+        self.on_attempt = on_attempt
+        self.phase_time = dict.fromkeys(STAT_PHASES, 0.0)
+        self.rejections = dict.fromkeys(STAT_RULES, 0)
+        self.deficits = []
+
+    @property
+    def attempts(self):
+        return len(self.deficits)
+
+    @property
+    def pruned(self):
+        return self.deficits.count(float('inf'))
+
+    def record_attempt(self, deficit):
+        self.deficits.append(deficit)
+        if self.on_attempt is not None:
+            self.on_attempt(self, deficit)
+
+    def merge(self, data):
+        # Fold in a to_dict() from a worker process
+        for phase, seconds in data['phase_time'].items():
+            self.phase_time[phase] += seconds
+        for rule, count in data['rejections'].items():
+            self.rejections[rule] += count
+        for deficit in data['deficits']:
+            self.record_attempt(deficit)
+
+    def to_dict(self):
+        return {'phase_time': dict(self.phase_time), 'rejections': dict(self.rejections),
+                'deficits': list(self.deficits)}
+
+# --- Logic Class ---
+
+class ScheduleGenerator:
+    def __init__(self, config, seed=None, stats=None):
+        self.config = config
+        self.rng = random.Random(seed)
+        self.stats = stats
+        self.year = config['year']
+        self.month = config['month']
+        self.staff_list = config['staff_list']
+        self.days_in_month = calendar.monthrange(self.year, self.month)[1]
+        self.days = list(range(1, self.days_in_month + 1))
+        self.staff_ids = [s['id'] for s in self.staff_list]
+        self.row_of = {sid: i for i, sid in enumerate(self.staff_ids)}
+        self.rules = RuleSet(config, self.year, self.month, self.days_in_month)
+
+        # Carry-over from the previous month: config['history'] maps staff id
+        # to its final days, oldest first (see carry_over()); day 1 sees the
+        # last of them as the previous day and continues the streak they end
+        history = config.get('history') or {}
+        self.carry_last = []
+        self.carry_streak = []
+        for sid in self.staff_ids:
+            tail = [CODE_OF.get(shift, C_NONE) for shift in history.get(sid, history.get(str(sid), []))]
+            streak = 0
+            while streak < len(tail) and IS_WORK_CODE[tail[-1 - streak]]:
+                streak += 1
+            self.carry_last.append(tail[-1] if tail else C_NONE)
+            self.carry_streak.append(streak)
+
+        # Optional warm start: config['template'] is an earlier roster for the
+        # same staff ({staff id: row}, e.g. last month's result['schedule']).
+        # Every other attempt prefers, among free candidates, the staff who
+        # had that shift on that day of the template.
+        template = config.get('template')
+        self.template_codes = None
+        if template:
+            self.template_codes = []
+            for sid in self.staff_ids:
+                row = template.get(sid, template.get(str(sid))) or []
+                self.template_codes.append([CODE_OF.get(row[d], C_NONE) if d < len(row) else C_NONE
+                                            for d in range(self.days_in_month + 1)])
+
+        # Per-staff data for the hot loops, built once: staff rows that may
+        # take each shift, the requested code per row and day (C_NONE if
+        # none), and the request pre-fill every attempt starts from
+        self.eligible_rows = {
+            shift: [not s.get('allowed_shifts') or shift in s['allowed_shifts'] for s in self.staff_list]
+            for shift in ALL_SHIFTS
+        }
+        self.request_codes = []
+        self.prefilled = ScheduleMatrix(len(self.staff_list), self.days_in_month)
+        for i, staff in enumerate(self.staff_list):
+            codes = [C_NONE] * (self.days_in_month + 1)
+            for day_str, shift in staff.get('requests', {}).items():
+                codes[int(day_str)] = CODE_OF[shift]
+            self.request_codes.append(codes)
+            for d, c in enumerate(self.request_cells(staff)):
+                if c != C_NONE:
+                    self.prefilled.set(i, d, c)
+
+        # What an attempt knows before its first day, all fixed by the
+        # pre-fill alone:
+        # - suffix_needs[shift][d]: Day/Night demand left from day d to the
+        #   month end. Only requests put Day/Night on future days, so this
+        #   stays exact for the whole attempt.
+        # - start_pool[shift]: rows still in the running for the shift, i.e.
+        #   allowed to take it and, for 夜/日, under their monthly cap.
+        # - start_remaining[shift]: what those rows can still take before
+        #   their 夜/日 caps.
+        self.suffix_needs = {}
+        self.start_pool = {shift: bytearray(rows) for shift, rows in self.eligible_rows.items()}
+        self.start_remaining = {}
+        need = self.rules.need
+        for shift in (SHIFT_DAY, SHIFT_NIGHT):
+            code = CODE_OF[shift]
+            needs = [0] * (self.days_in_month + 2)
+            for d in range(self.days_in_month, 0, -1):
+                needs[d] = needs[d + 1] + max(0, need[d * NUM_CODES + code] - self.prefilled.count(d, code))
+            self.suffix_needs[shift] = needs
+            caps = self.rules.cap[code]
+            totals = self.prefilled.totals_of(code)
+            in_pool = self.start_pool[shift]
+            self.start_remaining[shift] = sum(caps[row] - totals[row] for row in compress(range(len(totals)), in_pool)
+                                              if totals[row] < caps[row])
+            for row in range(len(totals)):
+                if totals[row] >= caps[row]:
+                    in_pool[row] = 0
+
+    def is_work_shift(self, shift):
+        return shift in [SHIFT_EARLY, SHIFT_DAY, SHIFT_LATE, SHIFT_NIGHT, SHIFT_DAWN]
+
+    @staticmethod
+    def carry_over(schedule):
+        # config['history'] for the following month from a result['schedule']
+        return {sid: list(row[-CARRY_DAYS:]) for sid, row in schedule.items()}
+
+    def prev_code(self, schedule, i, day):
+        # Code on the day before `day`, looking into the carried-over history on day 1
+        return schedule.get(i, day - 1) if day > 1 else self.carry_last[i]
+
+    def shuffle_list(self, lst):
+        self.rng.shuffle(lst)
+
+    def to_matrix(self, schedule):
+        return ScheduleMatrix.from_dict(schedule, self.staff_ids, self.days_in_month)
+
+    def generate(self, max_retries=None, workers=1, time_budget=None, target_deficit=0, on_progress=None,
+                 improve_time=0, evolve=False):
+        # Best of N Approach. With a time budget, attempts keep coming until the
+        # deadline; either way the search stops once target_deficit is reached.
+        # on_progress receives every progress snapshot and may return True to stop;
+        # the best schedule so far is still finalized, without the LocalSearch step.
+        # improve_time > 0 runs LocalSearch on the finalized best schedule.
+        # result['deficit'] is the coverage shortage of the returned roster and
+        # result['search_deficit'] the best count the search reached.
+        # evolve=True recombines the attempts with GeneticSearch (serially).
+        progress = None
+        stopped = False
+        snapshots = self.iter_generate(max_retries, workers, time_budget, target_deficit, evolve)
+        try:
+            for progress in snapshots:
+                if on_progress is not None and on_progress(progress):
+                    stopped = True
+                    break
+        finally:
+            snapshots.close()
+
+        best = None if progress is None else self.best_schedule(progress)
+        if best is None:
+            return {'success': False}
+
+        # GeneticSearch hands over a roster it finalized and ranked itself;
+        # finalizing it again would reshuffle it
+        schedule = best if 'schedule' in progress else self.finalize_matrix(best)
+        if improve_time > 0 and not stopped:
+            started = time.perf_counter()
+            schedule = self.improve(schedule, improve_time)
+            if self.stats is not None:
+                self.stats.phase_time['improve'] += time.perf_counter() - started
+
+        result = self.to_result(schedule)
+        result['deficit'] = self.coverage_shortage(schedule)
+        result['search_deficit'] = progress['deficit']
+        result['attempts'] = progress['attempts']
+        return result
+
+    def iter_generate(self, max_retries=None, workers=1, time_budget=None, target_deficit=0, evolve=False):
+        # Yields a progress snapshot after each attempt (serial) or batch
+        # (parallel): {'attempts', 'deficit', 'seed', 'guided', 'elapsed'},
+        # where deficit is the best so far and seed/guided replay the attempt
+        # that reached it (see best_schedule()). Stop iterating to stop early.
+        if max_retries is None and time_budget is None:
+            max_retries = DEFAULT_MAX_RETRIES
+        deadline = None if time_budget is None else time.monotonic() + time_budget
+        # No attempt can beat the capacity lower bound, so stop on reaching it
+        started = time.perf_counter()
+        target_deficit = max(target_deficit, self.analyze_capacity()['lower_bound'])
+        if self.stats is not None:
+            self.stats.phase_time['analyze'] += time.perf_counter() - started
+
+        if evolve:
+            return GeneticSearch(self).iter_run(max_retries, deadline, target_deficit)
+        if workers > 1:
+            return self.iter_search_parallel(max_retries, workers, deadline, target_deficit)
+        return self.iter_search(max_retries, deadline, target_deficit)
+
+    def best_schedule(self, progress):
+        # The best matrix of a progress snapshot: GeneticSearch hands over its
+        # roster, searches only record the winning attempt and it is rebuilt
+        # here from its seed. None if no attempt has finished yet.
+        if 'schedule' in progress:
+            return progress['schedule']
+        if progress['seed'] is None:
+            return None
+        # The replay is not a new attempt, so it stays out of the stats
+        stats, self.stats = self.stats, None
+        try:
+            return self.run_attempt(guided=progress['guided'], seed=progress['seed'])[1]
+        finally:
+            self.stats = stats
+
+    def iter_search(self, max_retries=None, deadline=None, target_deficit=0, stop_event=None, bound=float('inf')):
+        # `bound` is a deficit already achieved elsewhere (e.g. another worker);
+        # attempts that cannot beat it or the best found here are cut short.
+        # Only the best attempt's seed is kept, never its matrix.
+        start = time.monotonic()
+        best_seed = None
+        best_guided = False
+        min_deficit = float('inf')
+        attempts = 0
+
+        while max_retries is None or attempts < max_retries:
+            if stop_event is not None and stop_event.is_set():
+                break
+            # Always run at least one attempt so there is something to return
+            if deadline is not None and attempts and time.monotonic() >= deadline:
+                break
+
+            guided = self.template_codes is not None and attempts % 2 == 0
+            seed = self.rng.getrandbits(64)
+            current_deficit, _ = self.run_attempt(min(min_deficit, bound), guided, seed)
+            attempts += 1
+            if self.stats is not None:
+                self.stats.record_attempt(current_deficit)
+
+            if current_deficit < min_deficit:
+                min_deficit = current_deficit
+                best_seed = seed
+                best_guided = guided
+
+            yield {'attempts': attempts, 'deficit': min_deficit, 'seed': best_seed, 'guided': best_guided,
+                   'elapsed': time.monotonic() - start}
+
+            if min_deficit <= target_deficit:
+                break
+
+    def iter_search_parallel(self, max_retries, workers, deadline=None, target_deficit=0):
+        # Batches are kept small relative to the work so a hit on the target
+        # cancels the queued batches and slow batches do not stall the pool.
+        # Without a retry limit, batches are submitted until the deadline.
+        # Workers report the seed of their best attempt, which the worker's
+        # generator and this one (same config) replay identically.
+        # The pool modules are imported here so serial runs never load them.
+        # Workers are spawned, not forked: the app starts this search from a
+        # thread of a multi-threaded server, and a worker only needs this module.
+        import multiprocessing
+        from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+        start = time.monotonic()
+        if max_retries is None:
+            batch_size = PARALLEL_BATCH_SIZE
+        else:
+            batch_size = max(1, -(-max_retries // (workers * 4)))
+        unsubmitted = max_retries
+
+        best_seed = None
+        best_guided = False
+        min_deficit = float('inf')
+        attempts = 0
+
+        context = multiprocessing.get_context('spawn')
+        stop_event = context.Event()
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                   initializer=_init_search_worker, initargs=(stop_event,))
+        pending = set()
+
+        def submit_batch():
+            nonlocal unsubmitted
+            size = batch_size if unsubmitted is None else min(batch_size, unsubmitted)
+            time_budget = None if deadline is None else deadline - time.monotonic()
+            if size <= 0 or (time_budget is not None and time_budget <= 0 and attempts):
+                return False
+            if unsubmitted is not None:
+                unsubmitted -= size
+            pending.add(pool.submit(_search_worker, self.config, self.rng.getrandbits(64),
+                                    size, time_budget, target_deficit, min_deficit, self.stats is not None))
+            return True
+
+        try:
+            while len(pending) < workers * 2 and submit_batch():
+                pass
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.discard(future)
+                    seed, guided, deficit, batch_attempts, batch_stats = future.result()
+                    attempts += batch_attempts
+                    if batch_stats is not None:
+                        self.stats.merge(batch_stats)
+                    if seed is not None and deficit < min_deficit:
+                        min_deficit = deficit
+                        best_seed = seed
+                        best_guided = guided
+
+                yield {'attempts': attempts, 'deficit': min_deficit, 'seed': best_seed, 'guided': best_guided,
+                       'elapsed': time.monotonic() - start}
+
+                if min_deficit <= target_deficit:
+                    break
+                while len(pending) < workers * 2 and submit_batch():
+                    pass
+        finally:
+            stop_event.set()
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+
+    def run_attempt(self, bound=float('inf'), guided=False, seed=None):
+        # Returns (deficit, matrix), or (inf, None) once the attempt provably
+        # cannot finish below `bound` (the incumbent's deficit). A guided
+        # attempt tries the template's staff for each shift first. All of the
+        # attempt's randomness comes from `seed` (drawn from self.rng if not
+        # given), so run_attempt(guided=..., seed=...) rebuilds a finished
+        # attempt exactly: pruning only ever ends an attempt early.
+        stats = self.stats
+        if stats is not None:
+            started = time.perf_counter()
+        if seed is None:
+            seed = self.rng.getrandbits(64)
+        rng = random.Random(seed)
+
+        # 1. Pre-fill Requests (with the 明/公 after a requested 夜)
+        schedule = self.prefilled.copy()
+
+        rules = self.rules
+        transition = rules.transition
+        max_streak = rules.max_streak
+        day_cap = rules.cap[C_DAY]
+        night_cap = rules.cap[C_NIGHT]
+
+        # Rows leave the pools for good; every 夜/日 assigned below uses up
+        # exactly one unit of remaining
+        suffix_needs = self.suffix_needs
+        pool = {shift: bytearray(rows) for shift, rows in self.start_pool.items()}
+        remaining = dict(self.start_remaining)
+
+        if stats is not None:
+            stats.phase_time['prefill'] += time.perf_counter() - started
+        current_deficit = 0
+        is_free = bytearray(len(self.staff_list))
+        carry_last = self.carry_last
+        carry_streak = self.carry_streak
+
+        for day in self.days:
+            # Branch and bound: abandon once the deficit so far plus the demand
+            # nobody can cover any more already reaches the incumbent
+            if bound < float('inf'):
+                if current_deficit + self.unavoidable_deficit(remaining, suffix_needs, day) >= bound:
+                    return float('inf'), None
+
+            # Count assigned
+            column = schedule.column(day)
+            
+            # Needs
+            needs = []
+            for shift, count in rules.demand[day].items():
+                needed = count - schedule.count(day, CODE_OF[shift])
+                if needed > 0:
+                    needs.extend([shift] * needed)
+            
+            needs.sort(key=lambda x: 0 if x == SHIFT_NIGHT else 1)
+
+            # Available Staff (as matrix rows)
+            available_rows = [row for row, code in enumerate(column) if code == C_NONE]
+
+            # Check previous day sequences (Dawn/Night logic)
+            # Day 0 of the matrix is never assigned, so day 1 sees C_NONE
+            true_available = []
+            for row in available_rows:
+                prev_shift = schedule.get(row, day - 1)
+                
+                if prev_shift == C_NIGHT:
+                     schedule.set(row, day, C_DAWN)
+                elif prev_shift == C_DAWN:
+                     schedule.set(row, day, C_OFF)
+                else:
+                    true_available.append(row)
+            
+            available_rows = true_available
+            rng.shuffle(available_rows)
+            for row in available_rows:
+                is_free[row] = 1
+
+            # One candidate heap per shift type, built on first use today:
+            # fewest shifts of that type first, ties broken by today's shuffle.
+            # Entries are total * n_free + rank, so rank (and the row) is entry % n_free.
+            heaps = {}
+            n_free = len(available_rows)
+
+            for shift_type in needs:
+                if stats is not None:
+                    started = time.perf_counter()
+                code = CODE_OF[shift_type]
+
+                shift_totals = schedule.totals_of(code)
+
+                # Probabilistic Skip
+                if shift_type in [SHIFT_DAY, SHIFT_NIGHT]:
+                    remaining_capacity = remaining[shift_type]
+                    remaining_demand = rules.need_from[code][day]
+                    
+                    dynamic_ratio = 1.0
+                    if remaining_demand > 0:
+                        dynamic_ratio = remaining_capacity / remaining_demand
+                        if dynamic_ratio > 1.0: dynamic_ratio = 1.0
+                    
+                    if dynamic_ratio < 1.0:
+                        if rng.random() > dynamic_ratio:
+                            if stats is not None:
+                                stats.rejections['capacity_skip'] += 1
+                                stats.phase_time['sort'] += time.perf_counter() - started
+                            current_deficit += 1
+                            if current_deficit >= bound:
+                                return float('inf'), None
+                            continue
+
+                heap = heaps.get(shift_type)
+                if heap is None:
+                    in_pool = pool[shift_type]
+                    heap = [shift_totals[row] * n_free + rank for rank, row in enumerate(available_rows) if in_pool[row]]
+                    if guided:
+                        # Off-template rows sort after every template row
+                        template = self.template_codes
+                        heap = [entry if template[available_rows[entry % n_free]][day] == code
+                                else entry + TEMPLATE_PENALTY * n_free for entry in heap]
+                    heapq.heapify(heap)
+                    heaps[shift_type] = heap
+
+                if stats is not None:
+                    now = time.perf_counter()
+                    stats.phase_time['sort'] += now - started
+                    started = now
+                    rejections = stats.rejections
+
+                # Pop until a candidate passes. Hard-rule failures cannot pass
+                # later today either and are dropped; Late -> Early ones go back
+                chosen = None
+                fallback = None
+                deferred = []
+                while heap:
+                    entry = heapq.heappop(heap)
+                    row = available_rows[entry % n_free]
+                    if not is_free[row]:
+                        continue
+
+                    # Max Consecutive (continuing a streak from last month)
+                    limit = max_streak[row]
+                    streak = 0
+                    for k in range(1, limit + 2):
+                        if day - k < 1:
+                            streak += carry_streak[row]
+                            break
+                        if IS_WORK_CODE[schedule.get(row, day - k)]:
+                            streak += 1
+                        else:
+                            break
+                    
+                    if shift_type != SHIFT_NIGHT:
+                        if streak >= limit:
+                            if stats is not None: rejections['streak'] += 1
+                            continue
+                    
+                    if shift_type == SHIFT_NIGHT:
+                        if streak > limit: # one more allowed if Night
+                            if stats is not None: rejections['streak'] += 1
+                            continue
+
+                        if day + 1 <= self.days_in_month and schedule.get(row, day + 1) != C_NONE:
+                            if stats is not None: rejections['night_next_day'] += 1
+                            continue
+
+                    # Next-day rules from the previous day's shift
+                    prev_shift = schedule.get(row, day - 1) if day > 1 else carry_last[row]
+                    rule = transition[prev_shift * NUM_CODES + code]
+                    if rule == T_FORBID:
+                        if stats is not None: rejections['forbidden_transition'] += 1
+                        continue
+
+                    # Soft Constraint: avoided transitions (e.g. Late -> Early)
+                    if rule == T_AVOID:
+                        if stats is not None: rejections['avoided_transition'] += 1
+                        if fallback is None:
+                            fallback = entry
+                        else:
+                            deferred.append(entry)
+                        continue
+                    
+                    chosen = row
+                    break
+
+                if chosen is None and fallback is not None:
+                    chosen = available_rows[fallback % n_free]
+                elif fallback is not None:
+                    deferred.append(fallback)
+                for entry in deferred:
+                    heapq.heappush(heap, entry)
+                
+                if chosen is not None:
+                    row = chosen
+                    is_free[row] = 0
+                    schedule.set(row, day, code)
+
+                    # Capped shifts: a row at its monthly cap leaves the pool
+                    if shift_type == SHIFT_DAY:
+                        remaining[SHIFT_DAY] -= 1
+                        if schedule.total(row, C_DAY) >= day_cap[row]:
+                            pool[SHIFT_DAY][row] = 0
+                            if stats is not None: rejections['day_cap'] += 1
+                    
+                    if shift_type == SHIFT_NIGHT:
+                        remaining[SHIFT_NIGHT] -= 1
+                        if schedule.total(row, C_NIGHT) >= night_cap[row]:
+                            pool[SHIFT_NIGHT][row] = 0
+                            if stats is not None: rejections['night_cap'] += 1
+                        if day + 1 <= self.days_in_month:
+                            schedule.set(row, day + 1, C_DAWN)
+                        if day + 2 <= self.days_in_month and schedule.get(row, day + 2) == C_NONE:
+                            schedule.set(row, day + 2, C_OFF)
+
+                if stats is not None:
+                    stats.phase_time['assign'] += time.perf_counter() - started
+                
+                if chosen is None:
+                    current_deficit += 1
+                    if current_deficit >= bound:
+                        return float('inf'), None
+                    continue
+            
+            # Fill rest with OFF
+            for row in available_rows:
+                if is_free[row]:
+                    is_free[row] = 0
+                    schedule.set(row, day, C_OFF)
+
+        return current_deficit, schedule
+
+    def unavoidable_deficit(self, remaining, suffix_needs, day):
+        # Lower bound on the deficit still to come from `day` on: Day/Night
+        # demand beyond what eligible staff can take before their monthly caps
+        # (`remaining`, kept by run_attempt). Every Day/Night fill uses up one
+        # unit of that remaining capacity.
+        shortfall = 0
+        for shift in (SHIFT_DAY, SHIFT_NIGHT):
+            shortfall += max(0, suffix_needs[shift][day] - remaining[shift])
+        return shortfall
+
+    def request_cells(self, staff):
+        # Codes the request pre-fill puts on each day (index 0 unused), with
+        # the 明/公 that follow a requested 夜 or a 夜/明 carried over from the
+        # previous month; C_NONE where the day is free
+        cells = [C_NONE] * (self.days_in_month + 1)
+        last = self.carry_last[self.row_of[staff['id']]]
+        if last == C_NIGHT:
+            cells[1] = C_DAWN
+            if self.days_in_month >= 2:
+                cells[2] = C_OFF
+        elif last == C_DAWN:
+            cells[1] = C_OFF
+        for day_str, shift in staff.get('requests', {}).items():
+            day = int(day_str)
+            if day == 1 and last == C_NIGHT:
+                # The carried 明 is not negotiable
+                continue
+            cells[day] = CODE_OF[shift]
+            if shift == SHIFT_NIGHT:
+                if day + 1 <= self.days_in_month:
+                    cells[day + 1] = C_DAWN
+                if day + 2 <= self.days_in_month:
+                    cells[day + 2] = C_OFF
+        return cells
+
+    def analyze_capacity(self):
+        # Pre-solve counting check, run before any attempt. Returns
+        # {'lower_bound', 'bottlenecks'}: lower_bound is a deficit no roster can
+        # beat (0 means no bottleneck was found, not that a roster exists) and
+        # each bottleneck is {'day' (None = whole month), 'shift', 'required',
+        # 'available', 'message'}, month-wide ones first.
+        dim = self.days_in_month
+        cells = [self.request_cells(staff) for staff in self.staff_list]
+        allowed = [[CODE_OF[s] for s in staff.get('allowed_shifts') or ALL_SHIFTS] for staff in self.staff_list]
+        rules = self.rules
+        bottlenecks = []
+
+        # 夜/日 demand against the monthly caps; requested shifts always count
+        capped_bound = 0
+        for shift in (SHIFT_NIGHT, SHIFT_DAY):
+            code = CODE_OF[shift]
+            required = rules.need_from[code][1] if rules.need_from[code] else 0
+            available = 0
+            for row, codes, cap in zip(cells, allowed, rules.cap[code]):
+                requested = row.count(code)
+                free = row.count(C_NONE) - 1 if code in codes else 0
+                available += requested + min(max(0, cap - requested), free)
+            if available < required:
+                capped_bound += required - available
+                bottlenecks.append({'day': None, 'shift': shift, 'required': required, 'available': available,
+                                    'message': f"{shift}（月間）: 必要 {required} 回 / 割り当て可能 {available} 回"})
+
+        # Work days left after the 公 quota and paid leave; every 夜 but the
+        # last day's also costs a 明, so one missing slot frees at most two days
+        required = sum(sum(demand.values()) for demand in rules.demand)
+        required += sum(rules.need[d * NUM_CODES + C_NIGHT] for d in range(1, dim))
+        available = sum(
+            dim - max(off_days, row.count(C_OFF)) - row.count(C_PAID) for row, off_days in zip(cells, rules.off_days)
+        )
+        work_bound = 0
+        if available < required:
+            work_bound = (required - available + 1) // 2
+            bottlenecks.append({'day': None, 'shift': None, 'required': required, 'available': available,
+                                'message': f"勤務日数（月間）: 必要 {required} 日 / 公休確保後の勤務可能 {available} 日"})
+
+        # Per day: who can still take each shift, and who is free at all
+        day_bound = 0
+        for d in self.days:
+            shift_shortage = 0
+            available_total = 0
+            for shift, count in rules.demand[d].items():
+                code = CODE_OF[shift]
+                requested = 0
+                available = 0
+                for row, codes in zip(cells, allowed):
+                    if row[d] == code:
+                        requested += 1
+                    elif row[d] == C_NONE and code in codes and (code != C_NIGHT or d == dim or row[d + 1] == C_NONE):
+                        available += 1
+                available += requested
+                available_total += min(count, requested)
+                if available < count:
+                    shift_shortage += count - available
+                    bottlenecks.append({'day': d, 'shift': shift, 'required': count, 'available': available,
+                                        'message': f"{d}日 {shift}: 必要 {count} 人 / 担当可能 {available} 人"})
+            available_total += sum(1 for row in cells if row[d] == C_NONE)
+            required_total = sum(rules.demand[d].values())
+            if required_total - available_total > shift_shortage:
+                bottlenecks.append({'day': d, 'shift': None, 'required': required_total, 'available': available_total,
+                                    'message': f"{d}日: 必要 {required_total} 人 / 出勤可能 {available_total} 人"})
+            day_bound += max(shift_shortage, required_total - available_total)
+
+        return {'lower_bound': max(capped_bound, work_bound, day_bound), 'bottlenecks': bottlenecks}
+
+    def finalize_schedule(self, schedule):
+        return self.to_result(self.finalize_matrix(schedule))
+
+    def to_result(self, schedule):
+        return {'success': True, 'schedule': schedule.to_dict(self.staff_ids), 'days': self.days}
+
+    def improve(self, schedule, time_limit):
+        # Local-search repair of a finalized matrix (see LocalSearch)
+        best, _ = LocalSearch(self, schedule).run(time_limit)
+        return best
+
+    def repair(self, schedule, previous_requests, time_limit=0.3):
+        # Incremental re-generation after request edits. `schedule` is a
+        # result['schedule'] generated for the same month and staff with
+        # `previous_requests` ({staff id: requests}); this generator's config
+        # holds the edited requests. Only days within the longest work streak
+        # plus REPAIR_MARGIN of an edited cell may change, and LocalSearch pays PENALTY_CHANGE per cell
+        # that differs, so staff away from the edits keep their shifts.
+        base = self.to_matrix(schedule)
+        matrix = base.copy()
+        dim = self.days_in_month
+
+        edited = []
+        for i, staff in enumerate(self.staff_list):
+            old = [C_NONE] * (dim + 1)
+            for day_str, shift in previous_requests.get(staff['id'], {}).items():
+                old[int(day_str)] = CODE_OF[shift]
+            edited.extend((i, d) for d in self.days if old[d] != self.request_codes[i][d])
+
+        margin = self.rules.longest_streak + REPAIR_MARGIN
+        window = set()
+        for _, d in edited:
+            window.update(range(max(1, d - margin), min(dim, d + margin) + 1))
+
+        # New requests overwrite their cells like the pre-fill does
+        for i, d in edited:
+            code = self.request_codes[i][d]
+            if code == C_NONE:
+                continue
+            matrix.set(i, d, code)
+            if code == C_NIGHT:
+                if d + 1 <= dim:
+                    matrix.set(i, d + 1, C_DAWN)
+                if d + 2 <= dim:
+                    matrix.set(i, d + 2, C_OFF)
+        for i in {i for i, _ in edited}:
+            self.mend_night_chain(matrix, i, window)
+        for d in sorted(window):
+            self.refill_nights(matrix, d, window)
+
+        if window:
+            matrix, _ = LocalSearch(self, matrix, days=window, anchor=base).run(time_limit)
+        result = self.to_result(matrix)
+        result['deficit'] = self.coverage_shortage(matrix)
+        result['repaired_days'] = sorted(window)
+        result['changed_cells'] = sum(1 for a, b in zip(matrix.cells, base.cells) if a != b)
+        return result
+
+    def mend_night_chain(self, schedule, i, days):
+        # After an edit, a 明 without its 夜 becomes 公, a 夜 whose next day is
+        # requested as something else is dropped, and a 夜 gets its 明 and the
+        # 明 its 公 where those days are free
+        requested = self.request_codes[i]
+        dim = self.days_in_month
+        for d in sorted(days):
+            code = schedule.get(i, d)
+            if code == C_DAWN and self.prev_code(schedule, i, d) != C_NIGHT and requested[d] != C_DAWN:
+                schedule.set(i, d, C_OFF)
+            elif code == C_NIGHT and d < dim and schedule.get(i, d + 1) != C_DAWN:
+                if requested[d + 1] == C_NONE:
+                    schedule.set(i, d + 1, C_DAWN)
+                elif requested[d] != C_NIGHT:
+                    schedule.set(i, d, C_OFF)
+            elif code == C_DAWN and d < dim and schedule.get(i, d + 1) != C_OFF and requested[d + 1] == C_NONE:
+                schedule.set(i, d + 1, C_OFF)
+
+    def refill_nights(self, schedule, day, days):
+        # Put 夜→明→公 on free night-capable staff until `day` has its night
+        # headcount, preferring staff with the fewest nights so far. The 明/公
+        # must also fall in `days` (or past the month end).
+        dim = self.days_in_month
+        eligible = self.eligible_rows[SHIFT_NIGHT]
+        night_cap = self.rules.cap[C_NIGHT]
+        night_totals = schedule.totals_of(C_NIGHT)
+        candidates = []
+        for i in range(len(self.staff_list)):
+            requested = self.request_codes[i]
+            if not eligible[i] or night_totals[i] >= night_cap[i] or requested[day] != C_NONE:
+                continue
+            if schedule.get(i, day) not in (C_EARLY, C_DAY, C_LATE, C_OFF):
+                continue
+            if any(d <= dim and (d not in days or requested[d] != C_NONE or schedule.get(i, d) in (C_NIGHT, C_DAWN))
+                   for d in (day + 1, day + 2)):
+                continue
+            streak = 0
+            while day - streak - 1 >= 1 and IS_WORK_CODE[schedule.get(i, day - streak - 1)]:
+                streak += 1
+            if streak == day - 1:
+                streak += self.carry_streak[i]
+            if streak <= self.rules.max_streak[i]:
+                candidates.append((night_totals[i], i))
+
+        candidates.sort()
+        for _, i in candidates:
+            if schedule.count(day, C_NIGHT) >= self.rules.need[day * NUM_CODES + C_NIGHT]:
+                break
+            schedule.set(i, day, C_NIGHT)
+            if day + 1 <= dim:
+                schedule.set(i, day + 1, C_DAWN)
+            if day + 2 <= dim:
+                schedule.set(i, day + 2, C_OFF)
+
+    def coverage_shortage(self, schedule):
+        # Missing staff per day and shift type, summed over the month
+        # One strided slice per shift code of the demand and of the coverage
+        need = self.rules.need
+        coverage = schedule.coverage
+        shortage = 0
+        for code in self.rules.codes:
+            for wanted, have in zip(need[code::NUM_CODES], coverage[code::NUM_CODES]):
+                if have < wanted:
+                    shortage += wanted - have
+        return shortage
+
+    def shortage_report(self, schedule):
+        # The same shortage broken down as {shift: {day: missing}}, listing
+        # only the days that are short
+        report = {shift: {} for shift in self.rules.shifts}
+        for d in self.days:
+            for shift, count in self.rules.demand[d].items():
+                missing = count - schedule.count(d, CODE_OF[shift])
+                if missing > 0:
+                    report[shift][d] = missing
+        return report
+
+    def finalize_matrix(self, schedule):
+        # Work on a copy so a best-so-far matrix can be finalized mid-search
+        if isinstance(schedule, ScheduleMatrix):
+            schedule = schedule.copy()
+        else:
+            schedule = self.to_matrix(schedule)
+        stats = self.stats
+
+        can_work = [self.eligible_rows[shift] for shift in (SHIFT_EARLY, SHIFT_DAY, SHIFT_LATE)]
+        rules = self.rules
+        need = rules.need
+        transition = rules.transition
+
+        def fits(i, day, code):
+            # Neither the previous nor the next day forbids `code` here
+            next_code = schedule.get(i, day + 1) if day < self.days_in_month else C_NONE
+            return (transition[self.prev_code(schedule, i, day) * NUM_CODES + code] != T_FORBID
+                    and transition[code * NUM_CODES + next_code] != T_FORBID)
+
+        # Enforce the monthly Public Holidays
+        for i, (can_early, can_day, can_late) in enumerate(zip(*can_work)):
+            if stats is not None:
+                started = time.perf_counter()
+            off_target = rules.off_days[i]
+            day_target = rules.cap[C_DAY][i]
+            off_days_indices = []
+            requested = self.request_codes[i]
+            row = schedule.row(i)
+            
+            for d in range(1, self.days_in_month + 1):
+                # Requested holidays and the 公 after a 明 stay put
+                if row[d] == C_OFF and requested[d] != C_OFF and self.prev_code(schedule, i, d) != C_DAWN:
+                    off_days_indices.append(d)
+            
+            current_off_count = schedule.total(i, C_OFF)
+
+            # Case 1: Too many holidays
+            if current_off_count > off_target:
+                excess = current_off_count - off_target
+                self.shuffle_list(off_days_indices)
+                
+                removed = 0
+                
+                # Pass 1: Fill Shortages
+                for k in range(len(off_days_indices)):
+                    if removed >= excess: break
+                    d_idx = off_days_indices[k]
+                    
+                    base = d_idx * NUM_CODES
+                    needE = schedule.count(d_idx, C_EARLY) < need[base + C_EARLY]
+                    needD = schedule.count(d_idx, C_DAY) < need[base + C_DAY]
+                    needL = schedule.count(d_idx, C_LATE) < need[base + C_LATE]
+
+                    target_shift = None
+
+                    if needD and can_day and fits(i, d_idx, C_DAY):
+                        target_shift = C_DAY
+                    elif needE and can_early and fits(i, d_idx, C_EARLY):
+                         target_shift = C_EARLY
+                    elif needL and can_late and fits(i, d_idx, C_LATE):
+                         target_shift = C_LATE
+                    
+                    if target_shift:
+                        schedule.set(i, d_idx, target_shift)
+                        removed += 1
+                        off_days_indices[k] = -1
+                
+                # Pass 2: Overfill
+                if removed < excess:
+                    for k in range(len(off_days_indices)):
+                        if removed >= excess: break
+                        d_idx = off_days_indices[k]
+                        if d_idx == -1: continue
+                        
+                        target_shift = None
+
+                        if can_day and fits(i, d_idx, C_DAY):
+                            target_shift = C_DAY
+                        elif can_early and fits(i, d_idx, C_EARLY):
+                            target_shift = C_EARLY
+                        elif can_late and fits(i, d_idx, C_LATE):
+                            target_shift = C_LATE
+                        
+                        if target_shift:
+                            schedule.set(i, d_idx, target_shift)
+                            removed += 1
+            
+            # Case 2: Not enough holidays
+            elif current_off_count < off_target:
+                deficit = off_target - current_off_count
+                work_indices = []
+                for d in range(1, self.days_in_month + 1):
+                    if requested[d] != C_NONE: continue
+                    if row[d] in (C_EARLY, C_DAY, C_LATE):
+                        work_indices.append(d)
+                
+                self.shuffle_list(work_indices)
+                added = 0
+                for k in range(len(work_indices)):
+                    if added >= deficit: break
+                    schedule.set(i, work_indices[k], C_OFF)
+                    added += 1
+
+            # --- Enforce the monthly DAY Shifts ---
+            if stats is not None:
+                now = time.perf_counter()
+                stats.phase_time['holidays'] += now - started
+                started = now
+            if can_day:
+                row = schedule.row(i)
+                day_indices = []
+                for d in range(1, self.days_in_month + 1):
+                    if row[d] == C_DAY and requested[d] != C_DAY:
+                        day_indices.append(d)
+                
+                current_day_count = schedule.total(i, C_DAY)
+
+                if current_day_count > day_target:
+                    excess = current_day_count - day_target
+                    self.shuffle_list(day_indices)
+                    changed = 0
+                    for k in range(len(day_indices)):
+                        if changed >= excess: break
+                        d = day_indices[k]
+                        prev_shift = self.prev_code(schedule, i, d)
+                        
+                        target = None
+                        if can_early and transition[prev_shift * NUM_CODES + C_EARLY] == T_OK and fits(i, d, C_EARLY):
+                            target = C_EARLY
+                        elif can_late and fits(i, d, C_LATE):
+                             target = C_LATE
+                        elif can_early and fits(i, d, C_EARLY):
+                             target = C_EARLY
+                        
+                        if target:
+                            schedule.set(i, d, target)
+                            changed += 1
+                
+                elif current_day_count < day_target:
+                    deficit = day_target - current_day_count
+                    candidates = []
+                    for d in range(1, self.days_in_month + 1):
+                        if requested[d] != C_NONE: continue
+                        if row[d] in (C_EARLY, C_LATE):
+                            candidates.append(d)
+                    
+                    self.shuffle_list(candidates)
+                    changed = 0
+                    for k in range(len(candidates)):
+                         if changed >= deficit: break
+                         d = candidates[k]
+                         curr = schedule.get(i, d)
+
+                         # Critical Headcount Check
+                         if schedule.count(d, curr) <= need[d * NUM_CODES + curr]: continue
+
+                         if not fits(i, d, C_DAY): continue
+                         
+                         schedule.set(i, d, C_DAY)
+                         changed += 1
+
+            if stats is not None:
+                stats.phase_time['day_target'] += time.perf_counter() - started
+
+        # --- Post Processing: Early/Late headcount per day ---
+        if stats is not None:
+            started = time.perf_counter()
+
+        for day in range(1, self.days_in_month + 1):
+            early_count = schedule.count(day, C_EARLY)
+            late_count = schedule.count(day, C_LATE)
+            early_need = need[day * NUM_CODES + C_EARLY]
+            late_need = need[day * NUM_CODES + C_LATE]
+            if early_count >= early_need and late_count >= late_need:
+                continue
+            can_early, _, can_late = can_work
+            day_rows = [i for i, code in enumerate(schedule.column(day))
+                        if code == C_DAY and self.request_codes[i][day] != C_DAY]
+            
+            # Fill Early
+            skipped = []
+            while early_count < early_need and day_rows:
+                i = day_rows.pop()
+                if can_early[i] and fits(i, day, C_EARLY):
+                    schedule.set(i, day, C_EARLY)
+                    early_count += 1
+                else:
+                    skipped.append(i)
+            
+            # Day staff still on Day, in row order (skipped rows were popped
+            # from the end, so they go back on reversed)
+            day_rows.extend(reversed(skipped))
+
+            # Fill Late
+            while late_count < late_need and day_rows:
+                i = day_rows.pop()
+                if can_late[i] and fits(i, day, C_LATE):
+                    schedule.set(i, day, C_LATE)
+                    late_count += 1
+
+        if stats is not None:
+            stats.phase_time['early_late'] += time.perf_counter() - started
+        return schedule
+
+# --- Local Search ---
+
+# Penalty weights for LocalSearch. Coverage and hard rules dominate, the
+# monthly Day target and avoided transitions (Late -> Early) only break ties
+# between them. When
+# repairing a roster, every cell that differs from it costs PENALTY_CHANGE:
+# worth paying to fix coverage or a hard rule, but not for a tie-breaker.
+PENALTY_SHORTAGE = 10
+PENALTY_HARD = 20
+PENALTY_DAY_TARGET = 2
+PENALTY_AVOIDED = 1
+PENALTY_CHANGE = 3
+
+class LocalSearch:
+    # Simulated-annealing repair over a complete (finalized) matrix.
+    # Moves:
+    #   swap   - two staff exchange their shifts on one day
+    #   change - one staff switches between 公/早/日/遅 on one day
+    #   shift  - one staff exchanges two of their own days (keeps row totals)
+    # Requested cells and 夜/明 are never touched, so the night chain only
+    # needs the 公 after 明 to be checked. Each move is scored by re-evaluating
+    # just the rows and columns it touches against cached costs.
+    # `days` limits the search to those days; with `anchor` set, cells that
+    # differ from that matrix are penalized so the result stays close to it.
+    def __init__(self, generator, schedule, rng=None, days=None, anchor=None):
+        self.gen = generator
+        self.schedule = schedule.copy()
+        self.rng = rng or generator.rng
+        self.n_staff = len(generator.staff_list)
+        self.days_in_month = generator.days_in_month
+        self.days = generator.days if days is None else sorted(days)
+        self.rules = generator.rules
+        self.need_codes = generator.rules.codes
+        # Cost of each (previous day, day) code pair: the transition rules and
+        # the 公 that must follow a 明
+        self.pair_cost = [0] * (NUM_CODES * NUM_CODES)
+        for prev in range(NUM_CODES):
+            for c in range(NUM_CODES):
+                rule = self.rules.transition[prev * NUM_CODES + c]
+                cost = PENALTY_HARD if rule == T_FORBID else PENALTY_AVOIDED if rule == T_AVOID else 0
+                if prev == C_DAWN and c != C_OFF:
+                    cost += PENALTY_HARD
+                self.pair_cost[prev * NUM_CODES + c] = cost
+        self.anchor_rows = None if anchor is None else [anchor.row(i) for i in range(self.n_staff)]
+
+        self.locked = bytearray([1]) * (self.n_staff * (self.days_in_month + 1))
+        self.work_codes = []
+        self.day_target = []
+        for i, requested in enumerate(generator.request_codes):
+            for d in self.days:
+                if requested[d] == C_NONE and self.schedule.get(i, d) not in (C_NIGHT, C_DAWN, C_NONE, C_PAID):
+                    self.locked[d * self.n_staff + i] = 0
+            self.work_codes.append([CODE_OF[s] for s in NO_NIGHT_SHIFTS if generator.eligible_rows[s][i]])
+            self.day_target.append(self.rules.cap[C_DAY][i] if C_DAY in self.work_codes[i] else 0)
+
+        self.row_costs = [self.row_cost(i) for i in range(self.n_staff)]
+        self.col_costs = [0] + [self.col_cost(d) for d in generator.days]
+        self.cost = sum(self.row_costs) + sum(self.col_costs)
+
+    def row_cost(self, i, schedule=None):
+        # Cost of row i of the search's matrix, or of another matrix of the
+        # same generator (GeneticSearch scores its rosters this way)
+        if schedule is None:
+            schedule = self.schedule
+        row = schedule.row(i)
+        rules = self.rules
+        pair_cost = self.pair_cost
+        limit = rules.max_streak[i]
+        cost = 0
+        streak = self.gen.carry_streak[i]
+        prev = self.gen.carry_last[i] * NUM_CODES
+        for d in range(1, self.days_in_month + 1):
+            c = row[d]
+            if c == C_NIGHT:
+                if streak > limit: cost += PENALTY_HARD
+            elif C_EARLY <= c <= C_LATE:
+                if streak >= limit: cost += PENALTY_HARD
+            cost += pair_cost[prev + c]
+            streak = streak + 1 if IS_WORK_CODE[c] else 0
+            prev = c * NUM_CODES
+
+        cost += PENALTY_HARD * abs(schedule.total(i, C_OFF) - rules.off_days[i])
+        day_count = schedule.total(i, C_DAY)
+        day_cap = rules.cap[C_DAY][i]
+        if day_count > day_cap:
+            cost += PENALTY_HARD * (day_count - day_cap)
+        cost += PENALTY_DAY_TARGET * abs(day_count - self.day_target[i])
+        if self.anchor_rows is not None:
+            cost += PENALTY_CHANGE * sum(1 for a, b in zip(row, self.anchor_rows[i]) if a != b)
+        return cost
+
+    def col_cost(self, day):
+        return PENALTY_SHORTAGE * self.col_shortage(day)
+
+    def col_shortage(self, day):
+        need = self.rules.need
+        base = day * NUM_CODES
+        shortage = 0
+        for code in self.need_codes:
+            have = self.schedule.count(day, code)
+            if have < need[base + code]:
+                shortage += need[base + code] - have
+        return shortage
+
+    def is_free(self, i, day):
+        return not self.locked[day * self.n_staff + i]
+
+    def can_take(self, i, code):
+        return code == C_OFF or code in self.work_codes[i]
+
+    def propose(self, day_weights):
+        # Returns a list of (staff, day, new_code) cell writes, or None.
+        # day_weights are cumulative, favouring days with coverage gaps.
+        rng = self.rng
+        n = self.n_staff
+        day = rng.choices(self.days, cum_weights=day_weights)[0]
+        a = rng.randrange(n)
+        if not self.is_free(a, day):
+            return None
+        code_a = self.schedule.get(a, day)
+        move = rng.random()
+
+        if move < 0.4:
+            b = rng.randrange(n)
+            code_b = self.schedule.get(b, day)
+            if b == a or code_a == code_b or not self.is_free(b, day):
+                return None
+            if not self.can_take(a, code_b) or not self.can_take(b, code_a):
+                return None
+            return [(a, day, code_b), (b, day, code_a)]
+
+        if move < 0.7:
+            # Night-only staff have no day-time codes to change to
+            codes = [code for code in self.work_codes[a] + [C_OFF] if code != code_a]
+            if not codes:
+                return None
+            return [(a, day, rng.choice(codes))]
+
+        other = rng.choice(self.days)
+        if other == day or not self.is_free(a, other):
+            return None
+        code_other = self.schedule.get(a, other)
+        if code_other == code_a:
+            return None
+        return [(a, day, code_other), (a, other, code_a)]
+
+    def apply(self, writes):
+        # Applies the writes and returns (delta, undo info)
+        rows = {i for i, _, _ in writes}
+        cols = {d for _, d, _ in writes}
+        old_rows = [(i, self.row_costs[i]) for i in rows]
+        old_cols = [(d, self.col_costs[d]) for d in cols]
+        old_cells = [(i, d, self.schedule.get(i, d)) for i, d, _ in writes]
+        for i, d, code in writes:
+            self.schedule.set(i, d, code)
+
+        delta = 0
+        for i, old in old_rows:
+            self.row_costs[i] = self.row_cost(i)
+            delta += self.row_costs[i] - old
+        for d, old in old_cols:
+            self.col_costs[d] = self.col_cost(d)
+            delta += self.col_costs[d] - old
+        self.cost += delta
+        return delta, (old_cells, old_rows, old_cols)
+
+    def undo(self, delta, undo):
+        old_cells, old_rows, old_cols = undo
+        for i, d, code in old_cells:
+            self.schedule.set(i, d, code)
+        for i, old in old_rows:
+            self.row_costs[i] = old
+        for d, old in old_cols:
+            self.col_costs[d] = old
+        self.cost -= delta
+
+    def run(self, time_limit, max_iterations=None, start_temp=2.0, end_temp=0.05):
+        # Nothing to move without a free cell (e.g. no staff at all)
+        if 0 not in self.locked:
+            return self.schedule.copy(), self.cost
+        start = time.monotonic()
+        best = self.schedule.copy()
+        best_cost = self.cost
+        temp = start_temp
+        iteration = 0
+
+        while self.cost > 0:
+            if max_iterations is not None and iteration >= max_iterations:
+                break
+            if iteration % 256 == 0:
+                # Cool geometrically over the time limit; bias days with gaps
+                progress = (time.monotonic() - start) / time_limit if time_limit > 0 else 1.0
+                if progress >= 1.0:
+                    break
+                temp = start_temp * (end_temp / start_temp) ** progress
+                day_weights = list(accumulate(1 + self.col_costs[d] for d in self.days))
+            iteration += 1
+
+            writes = self.propose(day_weights)
+            if writes is None:
+                continue
+            delta, undo = self.apply(writes)
+            if delta <= 0 or self.rng.random() < math.exp(-delta / temp):
+                if self.cost < best_cost:
+                    best_cost = self.cost
+                    best = self.schedule.copy()
+            else:
+                self.undo(delta, undo)
+
+        return best, best_cost
+
+# --- Genetic Search ---
+
+# GeneticSearch sizes: rosters kept between generations, children bred per
+# generation, greedy attempts that seed the population, and the length of the
+# day block a block crossover takes from the second parent
+GENETIC_ELITE = 16
+GENETIC_CHILDREN = 32
+GENETIC_SEEDS = 32
+GENETIC_BLOCK_DAYS = 7
+# Share of children that are mutated, and short slots each mutation tries
+GENETIC_MUTATION_RATE = 0.5
+GENETIC_MUTATION_SLOTS = 4
+
+class GeneticSearch:
+    # Evolutionary search that recombines greedy attempts instead of keeping
+    # only the best one. The population holds finalized attempts ranked by
+    # coverage shortage, then by LocalSearch's cost (hard rules, 公 quota, 日
+    # target). A row's cost depends on that row alone, so children inherit
+    # their parents' row costs and only rows that changed are scored again.
+    # Children are bred by
+    #   row crossover   - each staff row comes whole from one parent, mostly
+    #                     the cheaper one, so rows keep their 夜→明→公 chain,
+    #                     streaks and caps
+    #   block crossover - GENETIC_BLOCK_DAYS days come from the second parent
+    #                     and the rows are repaired where the parents meet
+    # and some are mutated by moving staff into short slots within the rules.
+    # A generation is scored together and the best distinct rosters of
+    # parents and children survive.
+    def __init__(self, generator, elite=GENETIC_ELITE, children=GENETIC_CHILDREN, seeds=GENETIC_SEEDS):
+        self.gen = generator
+        self.rng = generator.rng
+        self.rules = generator.rules
+        self.elite = elite
+        self.children = children
+        self.seeds = max(seeds, elite)
+        self.n_staff = len(generator.staff_list)
+        self.days_in_month = generator.days_in_month
+        self.all_days = set(generator.days)
+        self.eligible = [None] * NUM_CODES
+        for shift, rows in generator.eligible_rows.items():
+            self.eligible[CODE_OF[shift]] = rows
+        self.scorer = None
+
+    def iter_run(self, max_retries=None, deadline=None, target_deficit=0):
+        # Yields iter_search()-style snapshots for the lowest-cost roster;
+        # 'attempts' counts greedy attempts and children alike, and
+        # max_retries bounds their sum
+        gen = self.gen
+        start = time.monotonic()
+        attempts = 0
+        population = []
+
+        def snapshot():
+            best = population[0]
+            return {'attempts': attempts, 'deficit': best['shortage'], 'schedule': best['schedule'],
+                    'elapsed': time.monotonic() - start}
+
+        def spent():
+            if max_retries is not None and attempts >= max_retries:
+                return True
+            return deadline is not None and attempts and time.monotonic() >= deadline
+
+        # Seed the population with finalized (unbounded) greedy attempts
+        while attempts < self.seeds and not spent():
+            guided = gen.template_codes is not None and attempts % 2 == 0
+            deficit, schedule = gen.run_attempt(guided=guided)
+            attempts += 1
+            if gen.stats is not None:
+                gen.stats.record_attempt(deficit)
+            schedule = gen.finalize_matrix(schedule)
+            if self.scorer is None:
+                self.scorer = LocalSearch(gen, schedule)
+            population = self.select(population + self.evaluate([(schedule, [None] * self.n_staff)]))
+            yield snapshot()
+            if population[0]['shortage'] <= target_deficit:
+                return
+
+        while not spent():
+            size = self.children if max_retries is None else min(self.children, max_retries - attempts)
+            brood = [self.breed(population) for _ in range(size)]
+            attempts += size
+            population = self.select(population + self.evaluate(brood))
+            yield snapshot()
+            if population[0]['shortage'] <= target_deficit:
+                return
+
+    def evaluate(self, brood):
+        # Scores a generation of (matrix, row costs) pairs, where a row cost
+        # of None marks a row to score again
+        scored = []
+        for schedule, row_costs in brood:
+            for i, cost in enumerate(row_costs):
+                if cost is None:
+                    row_costs[i] = self.scorer.row_cost(i, schedule)
+            shortage = self.gen.coverage_shortage(schedule)
+            scored.append({'cost': sum(row_costs) + PENALTY_SHORTAGE * shortage, 'tie': self.rng.random(),
+                           'shortage': shortage, 'schedule': schedule, 'row_costs': row_costs})
+        return scored
+
+    def select(self, candidates):
+        # Lowest shortage, then cost, first (random tie-break), one copy of
+        # each roster
+        survivors = []
+        seen = set()
+        for entry in sorted(candidates, key=self.rank):
+            key = entry['schedule'].cells.tobytes()
+            if key in seen:
+                continue
+            seen.add(key)
+            survivors.append(entry)
+            if len(survivors) == self.elite:
+                break
+        return survivors
+
+    @staticmethod
+    def rank(entry):
+        return entry['shortage'], entry['cost'], entry['tie']
+
+    def pick(self, population):
+        # Binary tournament
+        a = self.rng.choice(population)
+        b = self.rng.choice(population)
+        return a if self.rank(a) <= self.rank(b) else b
+
+    def breed(self, population):
+        first = self.pick(population)
+        second = self.pick(population)
+        if self.rng.random() < 0.5:
+            child, row_costs = self.row_crossover(first, second)
+        else:
+            child, row_costs = self.block_crossover(first, second)
+        if self.rng.random() < GENETIC_MUTATION_RATE:
+            for i in self.mutate(child):
+                row_costs[i] = None
+        return child, row_costs
+
+    def row_crossover(self, first, second):
+        child = first['schedule'].copy()
+        row_costs = list(first['row_costs'])
+        n = self.n_staff
+        cells = second['schedule'].cells
+        for i in range(n):
+            cheaper = second['row_costs'][i] < row_costs[i]
+            if self.rng.random() < (0.75 if cheaper else 0.25):
+                row_costs[i] = second['row_costs'][i]
+                for d in self.gen.days:
+                    code = cells[d * n + i]
+                    if child.cells[d * n + i] != code:
+                        child.set(i, d, code)
+        return child, row_costs
+
+    def block_crossover(self, first, second):
+        child = first['schedule'].copy()
+        row_costs = list(first['row_costs'])
+        n = self.n_staff
+        cells = second['schedule'].cells
+        start = self.rng.randint(1, self.days_in_month)
+        end = min(self.days_in_month, start + GENETIC_BLOCK_DAYS - 1)
+        for d in range(start, end + 1):
+            for i in range(n):
+                code = cells[d * n + i]
+                if child.cells[d * n + i] != code:
+                    child.set(i, d, code)
+                    row_costs[i] = None
+        for i, cost in enumerate(row_costs):
+            if cost is None:
+                self.repair_row(child, i)
+        return child, row_costs
+
+    def repair_row(self, schedule, i):
+        # Restores the 夜→明→公 chain, the streak limit, the forbidden
+        # transitions and the monthly caps on a row, turning cells the
+        # requests leave free into 公 (or 明 after a 夜)
+        requested = self.gen.request_codes[i]
+        transition = self.rules.transition
+        limit = self.rules.max_streak[i]
+        streak = self.gen.carry_streak[i]
+        prev = self.gen.carry_last[i]
+        for d in range(1, self.days_in_month + 1):
+            c = schedule.get(i, d)
+            free = requested[d] == C_NONE
+            if prev == C_NIGHT and c != C_DAWN:
+                if free:
+                    c = C_DAWN
+                elif d > 1 and requested[d - 1] == C_NONE:
+                    # The 夜 cannot have its 明; drop it instead
+                    schedule.set(i, d - 1, C_OFF)
+                    streak = 0
+            elif prev == C_DAWN and c != C_OFF and free:
+                c = C_OFF
+            elif c == C_DAWN and prev != C_NIGHT and free:
+                c = C_OFF
+            elif free and (C_EARLY <= c <= C_LATE and streak >= limit or c == C_NIGHT and streak > limit
+                           or transition[prev * NUM_CODES + c] == T_FORBID):
+                c = C_OFF
+            if c != schedule.get(i, d):
+                schedule.set(i, d, c)
+            streak = streak + 1 if IS_WORK_CODE[c] else 0
+            prev = c
+
+        for code in (C_NIGHT, C_DAY):
+            excess = schedule.total(i, code) - self.rules.cap[code][i]
+            if excess <= 0:
+                continue
+            days = [d for d in self.gen.days if schedule.get(i, d) == code and requested[d] == C_NONE]
+            for d in self.rng.sample(days, min(excess, len(days))):
+                schedule.set(i, d, C_OFF)
+                # The 明 of a dropped 夜 becomes 公; the 公 after it stays
+                if code == C_NIGHT and d < self.days_in_month and requested[d + 1] == C_NONE:
+                    schedule.set(i, d + 1, C_OFF)
+
+    def mutate(self, schedule):
+        # Moves staff into a few short (day, shift) slots: 夜 through
+        # refill_nights, other shifts from an overstaffed shift or a 公 the
+        # row can spare, as long as the rules still hold. Returns the rows
+        # that changed.
+        need = self.rules.need
+        short = [(d, code) for d in self.gen.days for code in self.rules.codes
+                 if schedule.count(d, code) < need[d * NUM_CODES + code]]
+        changed = set()
+        for d, code in self.rng.sample(short, min(GENETIC_MUTATION_SLOTS, len(short))):
+            if schedule.count(d, code) >= need[d * NUM_CODES + code]:
+                continue
+            if code == C_NIGHT:
+                before = schedule.column(d)
+                self.gen.refill_nights(schedule, d, self.all_days)
+                changed.update(i for i, (old, new) in enumerate(zip(before, schedule.column(d))) if old != new)
+                continue
+            candidates = [i for i in range(self.n_staff) if self.can_move(schedule, i, d, code)]
+            if candidates:
+                i = self.rng.choice(candidates)
+                schedule.set(i, d, code)
+                changed.add(i)
+        return changed
+
+    def can_move(self, schedule, i, d, code):
+        if not self.eligible[code][i] or self.gen.request_codes[i][d] != C_NONE:
+            return False
+        current = schedule.get(i, d)
+        prev = self.gen.prev_code(schedule, i, d)
+        if C_EARLY <= current <= C_LATE:
+            if schedule.count(d, current) <= self.rules.need[d * NUM_CODES + current]:
+                return False
+        elif current != C_OFF or prev == C_DAWN or schedule.total(i, C_OFF) <= self.rules.off_days[i]:
+            return False
+        if code == C_DAY and schedule.total(i, C_DAY) >= self.rules.cap[C_DAY][i]:
+            return False
+        transition = self.rules.transition
+        following = schedule.get(i, d + 1) if d < self.days_in_month else C_NONE
+        if transition[prev * NUM_CODES + code] == T_FORBID or transition[code * NUM_CODES + following] == T_FORBID:
+            return False
+        return current != C_OFF or self.fits_streak(schedule, i, d)
+
+    def fits_streak(self, schedule, i, d):
+        # Whether a work shift on a 公 day `d` keeps the streak limit for the
+        # run it joins
+        limit = self.rules.max_streak[i]
+        streak = 0
+        k = d - 1
+        while k >= 1 and IS_WORK_CODE[schedule.get(i, k)]:
+            streak += 1
+            k -= 1
+        if k == 0:
+            streak += self.gen.carry_streak[i]
+        if streak >= limit:
+            return False
+        for k in range(d + 1, self.days_in_month + 1):
+            streak += 1
+            c = schedule.get(i, k)
+            if not IS_WORK_CODE[c]:
+                break
+            if C_EARLY <= c <= C_LATE and streak >= limit or c == C_NIGHT and streak > limit:
+                return False
+        return True
+
+# --- Exact Solver ---
+
+# Domain bitmasks: bit c is set when shift code c is still possible
+BIT = [1 << c for c in range(NUM_CODES)]
+B_EARLY, B_DAY, B_LATE, B_NIGHT, B_DAWN, B_OFF, B_PAID = BIT[1:]
+B_NON_NIGHT = B_EARLY | B_DAY | B_LATE
+B_WORK = B_NON_NIGHT | B_NIGHT | B_DAWN
+
+# ExactSolver restarts: first node limit and its growth per restart
+RESTART_NODES = 2000
+RESTART_GROWTH = 1.5
+
+class Conflict(Exception):
+    # Raised by ExactSolver propagation when a domain or count bound fails
+    pass
+
+class ExactSolver:
+    # Backtracking search with constraint propagation for a deficit-0 roster.
+    # Every (staff, day) cell holds a bitmask domain over the shift codes,
+    # pruned by allowed shifts, requests, the 夜→明→公 chain, the forbidden
+    # transitions (no consecutive 日), the streak limit and the monthly 夜/日
+    # caps. Each staff month has exactly its 公 quota (more if requested) and
+    # every day must meet its headcount, which bounds the search per staff row
+    # and per day column. Avoided transitions are not enforced.
+    # Search is day-major, so a later cell only ever depends on fixed history.
+    def __init__(self, config, seed=None):
+        self.generator = ScheduleGenerator(config, seed=seed)
+        self.rng = self.generator.rng
+        gen = self.generator
+        self.n_staff = n = len(gen.staff_list)
+        self.days_in_month = dim = gen.days_in_month
+        rules = gen.rules
+        self.need = rules.need
+        self.need_codes = rules.codes
+        self.max_streak = rules.max_streak
+        self.caps = ((C_NIGHT, rules.cap[C_NIGHT]), (C_DAY, rules.cap[C_DAY]))
+
+        # Codes a fixed cell rules out on the next day, and on the day before
+        self.forbid_next = [0] * NUM_CODES
+        self.forbid_prev = [0] * NUM_CODES
+        for prev in range(NUM_CODES):
+            for code in range(1, NUM_CODES):
+                if rules.transition[prev * NUM_CODES + code] == T_FORBID:
+                    self.forbid_next[prev] |= BIT[code]
+                    self.forbid_prev[code] |= BIT[prev]
+
+        # Flat day-major domains (index day * n + staff); day 0 stays empty
+        self.dom = [0] * (n * (dim + 1))
+        self.off_target = []
+        self.paid_days = []
+        for i, staff in enumerate(gen.staff_list):
+            allowed = staff.get('allowed_shifts') or ALL_SHIFTS
+            base = B_OFF | B_DAWN
+            for s in allowed:
+                base |= BIT[CODE_OF[s]]
+            # A free day 1 cannot be 明 (a carried-over 夜 fixes it already),
+            # nor what the carried-over last shift forbids (日 after 日)
+            cells = [BIT[c] if c != C_NONE else base for c in gen.request_cells(staff)]
+            if cells[1] == base:
+                cells[1] &= ~(B_DAWN | self.forbid_next[gen.carry_last[i]])
+            for d in gen.days:
+                self.dom[d * n + i] = cells[d]
+            self.off_target.append(max(rules.off_days[i], cells.count(B_OFF)))
+            self.paid_days.append(cells.count(B_PAID))
+
+        # Per-row and per-column counts of cells that may / must take a code
+        self.row_possible = [0] * (n * NUM_CODES)
+        self.row_fixed = [0] * (n * NUM_CODES)
+        self.col_possible = [0] * ((dim + 1) * NUM_CODES)
+        self.col_fixed = [0] * ((dim + 1) * NUM_CODES)
+        self.col_open = [0] * (dim + 1)
+        self.row_open = [0] * n
+        for d in gen.days:
+            for i in range(n):
+                v = self.dom[d * n + i]
+                for c in range(1, NUM_CODES):
+                    if v & BIT[c]:
+                        self.row_possible[i * NUM_CODES + c] += 1
+                        self.col_possible[d * NUM_CODES + c] += 1
+                if v & (v - 1):
+                    self.col_open[d] += 1
+                    self.row_open[i] += 1
+                else:
+                    c = v.bit_length() - 1
+                    self.row_fixed[i * NUM_CODES + c] += 1
+                    self.col_fixed[d * NUM_CODES + c] += 1
+
+        self.off_pace = [off_days / dim for off_days in rules.off_days]
+        self.trail = []
+        self.queue = []
+
+    # --- domain updates ---
+
+    def narrow(self, idx, mask):
+        old = self.dom[idx]
+        new = old & mask
+        if new == old:
+            return
+        n = self.n_staff
+        i = idx % n
+        d = idx // n
+        if not new:
+            raise Conflict(f"{self.generator.staff_list[i]['name']}の{d}日に割り当てられる勤務がありません")
+        self.trail.append((idx, old))
+        self.dom[idx] = new
+
+        removed = old & ~new
+        while removed:
+            b = removed & -removed
+            c = b.bit_length() - 1
+            self.row_possible[i * NUM_CODES + c] -= 1
+            self.col_possible[d * NUM_CODES + c] -= 1
+            removed ^= b
+        if not new & (new - 1):
+            c = new.bit_length() - 1
+            self.row_fixed[i * NUM_CODES + c] += 1
+            self.col_fixed[d * NUM_CODES + c] += 1
+            self.col_open[d] -= 1
+            self.row_open[i] -= 1
+
+        self.check_row(i)
+        self.check_col(d)
+        self.queue.append(idx)
+
+    def remove(self, idx, mask):
+        self.narrow(idx, ~mask)
+
+    def undo_to(self, mark):
+        n = self.n_staff
+        trail = self.trail
+        while len(trail) > mark:
+            idx, old = trail.pop()
+            cur = self.dom[idx]
+            i = idx % n
+            d = idx // n
+            added = old & ~cur
+            while added:
+                b = added & -added
+                c = b.bit_length() - 1
+                self.row_possible[i * NUM_CODES + c] += 1
+                self.col_possible[d * NUM_CODES + c] += 1
+                added ^= b
+            if not cur & (cur - 1) and old & (old - 1):
+                c = cur.bit_length() - 1
+                self.row_fixed[i * NUM_CODES + c] -= 1
+                self.col_fixed[d * NUM_CODES + c] -= 1
+                self.col_open[d] += 1
+                self.row_open[i] += 1
+            self.dom[idx] = old
+
+    # --- bounds ---
+
+    def check_row(self, i):
+        base = i * NUM_CODES
+        off_target = self.off_target[i]
+        if self.row_fixed[base + C_OFF] > off_target or self.row_possible[base + C_OFF] < off_target:
+            raise Conflict(f"{self.generator.staff_list[i]['name']}の公休 {off_target} 日を確保できません")
+        if any(self.row_fixed[base + code] > cap[i] for code, cap in self.caps):
+            raise Conflict(f"{self.generator.staff_list[i]['name']}の夜勤・日勤の上限を超えています")
+
+    def check_col(self, d):
+        base = d * NUM_CODES
+        missing = 0
+        for c in self.need_codes:
+            if self.col_possible[base + c] < self.need[base + c]:
+                raise Conflict(f"{d}日の{SHIFT_CODES[c]}を担当できるスタッフが足りません")
+            missing += max(0, self.need[base + c] - self.col_fixed[base + c])
+        if missing > self.col_open[d]:
+            raise Conflict(f"{d}日の必要人数を満たせるスタッフが足りません")
+
+    def check_capped(self):
+        # Open 夜/日 demand must fit in what the staff have left under their caps
+        n = self.n_staff
+        for code, cap in self.caps:
+            demand = 0
+            for d in self.generator.days:
+                demand += max(0, self.need[d * NUM_CODES + code] - self.col_fixed[d * NUM_CODES + code])
+            capacity = 0
+            for i in range(n):
+                fixed = self.row_fixed[i * NUM_CODES + code]
+                capacity += min(cap[i] - fixed, self.row_possible[i * NUM_CODES + code] - fixed)
+            if capacity < demand:
+                raise Conflict(f"{SHIFT_CODES[code]}の必要数 {demand} に対し割り当て可能な数は {capacity} です")
+
+    def check_totals(self):
+        # Month-wide counting bounds, checked once before the search
+        n = self.n_staff
+        dim = self.days_in_month
+        self.check_capped()
+
+        # Work days are fixed by the 公 quota and paid leave; every 夜 before
+        # the last day also needs a 明 that does not count towards headcount
+        capacity = sum(dim - self.off_target[i] - self.paid_days[i] for i in range(n))
+        required = sum(self.need[d * NUM_CODES + c] for d in self.generator.days for c in self.need_codes)
+        required += sum(self.need[d * NUM_CODES + C_NIGHT] for d in range(1, dim))
+        if capacity < required:
+            raise Conflict(f"必要な勤務数 {required} に対し勤務可能な日数は {capacity} です")
+
+    # --- propagation ---
+
+    def propagate(self):
+        n = self.n_staff
+        dim = self.days_in_month
+        dom = self.dom
+        queue = self.queue
+        while queue:
+            idx = queue.pop()
+            i = idx % n
+            d = idx // n
+            v = dom[idx]
+
+            # 夜 <-> 明 on the next day, 明 -> 公 on the next day, and the
+            # forbidden transitions around a fixed cell
+            fixed = 0 if v & (v - 1) else v.bit_length() - 1
+            if d < dim:
+                nxt = idx + n
+                if v == B_NIGHT:
+                    self.narrow(nxt, B_DAWN)
+                elif not v & B_NIGHT:
+                    self.remove(nxt, B_DAWN)
+                if v == B_DAWN:
+                    self.narrow(nxt, B_OFF)
+                if self.forbid_next[fixed]:
+                    self.remove(nxt, self.forbid_next[fixed])
+            if d > 1:
+                prv = idx - n
+                if v == B_DAWN:
+                    self.narrow(prv, B_NIGHT)
+                elif not v & B_DAWN:
+                    self.remove(prv, B_NIGHT)
+                if not v & B_OFF:
+                    self.remove(prv, B_DAWN)
+                if self.forbid_prev[fixed]:
+                    self.remove(prv, self.forbid_prev[fixed])
+
+            # A definite work day may close a streak for the following days
+            if not v & ~B_WORK:
+                for e in range(d + 1, min(dim, d + self.max_streak[i] + 1) + 1):
+                    self.prune_streak(i, e)
+
+            self.prune_row(i)
+            self.prune_col(d)
+
+    def prune_streak(self, i, day):
+        n = self.n_staff
+        limit = self.max_streak[i]
+        streak = 0
+        for k in range(1, limit + 2):
+            if day - k < 1:
+                streak += self.generator.carry_streak[i]
+                break
+            if self.dom[(day - k) * n + i] & ~B_WORK:
+                break
+            streak += 1
+        if streak >= limit:
+            self.remove(day * n + i, B_NON_NIGHT)
+        if streak > limit:
+            self.remove(day * n + i, B_NIGHT)
+
+    def prune_row(self, i):
+        # Once a monthly count is settled, the rest of the row follows
+        n = self.n_staff
+        base = i * NUM_CODES
+        off_target = self.off_target[i]
+        for code, low, high in ((C_OFF, off_target, off_target), (C_NIGHT, 0, self.caps[0][1][i]),
+                                (C_DAY, 0, self.caps[1][1][i])):
+            fixed = self.row_fixed[base + code]
+            possible = self.row_possible[base + code]
+            if fixed == high and possible > high:
+                for d in self.generator.days:
+                    v = self.dom[d * n + i]
+                    if v & BIT[code] and v & (v - 1):
+                        self.remove(d * n + i, BIT[code])
+            elif possible == low and fixed < low:
+                for d in self.generator.days:
+                    if self.dom[d * n + i] & BIT[code]:
+                        self.narrow(d * n + i, BIT[code])
+
+    def prune_col(self, d):
+        # A shift with exactly as many candidates as its headcount takes them all
+        n = self.n_staff
+        base = d * NUM_CODES
+        for c in self.need_codes:
+            if self.col_possible[base + c] == self.need[base + c] and self.col_fixed[base + c] < self.need[base + c]:
+                for i in range(n):
+                    if self.dom[d * n + i] & BIT[c]:
+                        self.narrow(d * n + i, BIT[c])
+
+    # --- search ---
+
+    def rest_pressure(self, i):
+        # Share of the row's open cells that still have to become 公
+        offs_left = self.off_target[i] - self.row_fixed[i * NUM_CODES + C_OFF]
+        return offs_left / self.row_open[i] if self.row_open[i] else 0.0
+
+    def value_order(self, idx):
+        # Candidate codes for a cell, best last (they are popped). Shifts the
+        # day still needs come first; otherwise 公 is preferred only when the
+        # row is behind its monthly pace of 公.
+        n = self.n_staff
+        i = idx % n
+        d = idx // n
+        v = self.dom[idx]
+        base = d * NUM_CODES
+        rest_first = self.rest_pressure(i) >= self.off_pace[i]
+        scored = []
+        for c in range(1, NUM_CODES):
+            if not v & BIT[c]:
+                continue
+            missing = self.need[base + c] - self.col_fixed[base + c]
+            if missing > 0:
+                score = 100 + missing * 10 + (5 if c == C_NIGHT else 0)
+            elif c == C_OFF:
+                score = 60 if rest_first else 20
+            elif c == C_DAY:
+                score = 30
+            else:
+                score = 40
+            scored.append((score, self.rng.random(), c))
+        scored.sort()
+        return [c for _, _, c in scored]
+
+    def next_open(self, day):
+        # Earliest day with an open cell; within it, the staff member under
+        # the least pressure to rest goes first and so takes the needed shifts
+        n = self.n_staff
+        dom = self.dom
+        for d in range(day, self.days_in_month + 1):
+            if not self.col_open[d]:
+                continue
+            best = None
+            best_key = None
+            for i in range(n):
+                v = dom[d * n + i]
+                if v & (v - 1):
+                    key = self.rest_pressure(i) + self.rng.random() * 0.01
+                    if best is None or key < best_key:
+                        best = d * n + i
+                        best_key = key
+            return best
+        return None
+
+    def solve(self, time_limit=10):
+        # Returns generate()'s result dict plus 'status': 'optimal' (deficit-0
+        # roster found), 'infeasible' (with 'reason') or 'timeout'.
+        # The search restarts with growing node limits and randomized tie
+        # breaks to escape bad early decisions; a run that exhausts its tree
+        # within the limit proves infeasibility.
+        deadline = time.monotonic() + time_limit
+        report = self.generator.analyze_capacity()
+        if report['lower_bound'] > 0:
+            return {'success': False, 'status': 'infeasible', 'reason': report['bottlenecks'][0]['message'],
+                    'bottlenecks': report['bottlenecks']}
+        try:
+            for i in range(self.n_staff):
+                self.check_row(i)
+            for d in self.generator.days:
+                self.check_col(d)
+            # Streaks carried over from last month bound the first days
+            for i in range(self.n_staff):
+                if self.generator.carry_streak[i]:
+                    for e in range(1, min(self.days_in_month, self.max_streak[i] + 1) + 1):
+                        self.prune_streak(i, e)
+            self.queue = list(range(self.n_staff, len(self.dom)))
+            self.propagate()
+            self.check_totals()
+        except Conflict as e:
+            return {'success': False, 'status': 'infeasible', 'reason': str(e)}
+
+        root = len(self.trail)
+        node_limit = RESTART_NODES
+        while True:
+            status = self.search(deadline, node_limit)
+            if status != 'restart':
+                break
+            self.undo_to(root)
+            node_limit = int(node_limit * RESTART_GROWTH)
+
+        if status == 'timeout':
+            return {'success': False, 'status': 'timeout'}
+        if status == 'infeasible':
+            return {'success': False, 'status': 'infeasible',
+                    'reason': "すべての組み合わせを探索しましたが条件を満たす勤務表はありません"}
+
+        schedule = ScheduleMatrix(self.n_staff, self.days_in_month)
+        for d in self.generator.days:
+            for i in range(self.n_staff):
+                schedule.set(i, d, self.dom[d * self.n_staff + i].bit_length() - 1)
+        result = self.generator.to_result(schedule)
+        result['deficit'] = 0
+        result['status'] = 'optimal'
+        return result
+
+    def search(self, deadline, node_limit):
+        # Depth-first search from the current (propagated) state. Returns
+        # 'optimal', 'infeasible', 'timeout' or 'restart' (node limit hit).
+        stack = []
+        nodes = 0
+        idx = self.next_open(1)
+        while idx is not None:
+            stack.append((idx, self.value_order(idx), len(self.trail)))
+            while True:
+                if not stack:
+                    return 'infeasible'
+                cell, values, mark = stack[-1]
+                self.undo_to(mark)
+                if not values:
+                    stack.pop()
+                    continue
+                nodes += 1
+                if nodes >= node_limit:
+                    return 'restart'
+                if nodes % 256 == 0 and time.monotonic() > deadline:
+                    return 'timeout'
+                try:
+                    self.narrow(cell, BIT[values.pop()])
+                    self.propagate()
+                    self.check_capped()
+                    break
+                except Conflict:
+                    self.queue.clear()
+            idx = self.next_open(cell // self.n_staff)
+        return 'optimal'
+
+# --- Result Cache ---
+
+DEFAULT_CACHE_ENTRIES = 32
+
+
+class ResultCache:
+    # LRU cache of generation results keyed on the normalized config and the
+    # run options (engine, seed, budget, ...). Keys are content hashes, so a
+    # change to one month's inputs only misses for that month. With cache_dir
+    # set, results are also written there as JSON and survive restarts.
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        # One instance is shared by every session of the server
+        self.lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(config, options):
+        # Names do not affect the roster and allowed shifts are a set; request
+        # order is kept because the pre-fill applies requests in order
+        import hashlib
+
+        staff = [
+            [s['id'],
+             [shift for shift in ALL_SHIFTS if not s.get('allowed_shifts') or shift in s['allowed_shifts']],
+             [[str(d), shift] for d, shift in s.get('requests', {}).items()],
+             s.get('limits') or {}]
+            for s in config['staff_list']
+        ]
+        rules = {key: {str(k): v for k, v in value.items()} if isinstance(value, dict) else value
+                 for key, value in (config.get('rules') or {}).items()}
+        canonical = {
+            'year': config['year'],
+            'month': config['month'],
+            'headcount': config.get('headcount', DEFAULT_HEADCOUNT),
+            'staff': staff,
+            'rules': rules,
+            # Carried-over days and the warm-start template change the result too
+            'history': {str(sid): list(tail) for sid, tail in (config.get('history') or {}).items()},
+            'template': {str(sid): list(row) for sid, row in (config.get('template') or {}).items()},
+            'options': options,
+        }
+        payload = json.dumps(canonical, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        # Returns a copy of the cached result, or None
+        with self.lock:
+            result = self.entries.get(key)
+            if result is not None:
+                self.entries.move_to_end(key)
+        if result is None and self.cache_dir:
+            result = self.load(key)
+            if result is not None:
+                self.remember(key, result)
+        return None if result is None else self.copy_result(result)
+
+    def put(self, key, result):
+        # Timeouts depend on machine load, so only settled results are kept
+        if result.get('status') == 'timeout':
+            return
+        result = self.copy_result(result)
+        self.remember(key, result)
+        if self.cache_dir:
+            self.save(key, result)
+
+    def remember(self, key, result):
+        with self.lock:
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def copy_result(self, result):
+        result = dict(result)
+        if 'schedule' in result:
+            result['schedule'] = {sid: list(row) for sid, row in result['schedule'].items()}
+        return result
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def load(self, key):
+        try:
+            with open(self.path(key), encoding='utf-8') as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # JSON object keys are strings; schedules are stored as [id, row] pairs
+        if 'schedule' in result:
+            result['schedule'] = {sid: row for sid, row in result['schedule']}
+        return result
+
+    def save(self, key, result):
+        data = dict(result)
+        if 'schedule' in data:
+            data['schedule'] = [[sid, row] for sid, row in data['schedule'].items()]
+        tmp_path = self.path(key) + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path(key))
+        except (OSError, TypeError, ValueError):
+            # The disk tier is best effort; the in-memory entry still stands
+            pass
+
+# --- Parallel search workers ---
+
+_worker_stop_event = None
+
+def _init_search_worker(stop_event):
+    global _worker_stop_event
+    _worker_stop_event = stop_event
+
+def _search_worker(config, seed, attempts, time_budget=None, target_deficit=0, bound=float('inf'),
+                   collect_stats=False):
+    # One batch of attempts in a pool process, with its own independent RNG.
+    # Returns the (seed, guided) of the batch's best attempt, or a None seed
+    # if nothing in the batch beat `bound`, and the batch's
+    # GenerationStats.to_dict() when collect_stats is set.
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    stats = GenerationStats() if collect_stats else None
+    generator = ScheduleGenerator(config, seed=seed, stats=stats)
+    progress = None
+    for progress in generator.iter_search(attempts, deadline, target_deficit, _worker_stop_event, bound):
+        pass
+    if progress is None:
+        return None, False, float('inf'), 0, stats.to_dict() if stats else None
+    if progress['deficit'] <= target_deficit:
+        _worker_stop_event.set()
+    return (progress['seed'], progress['guided'], progress['deficit'], progress['attempts'],
+            stats.to_dict() if stats else None)
+
+# --- Background Jobs ---
+
+class WorkerBudget:
+    # Search processes shared by the jobs of one server. A job takes what is
+    # free when it starts, at least one (a serial search on its own thread),
+    # and gives it back when it ends.
+    def __init__(self, total):
+        self.lock = threading.Lock()
+        self.free = total
+
+    def take(self, wanted):
+        with self.lock:
+            workers = max(1, min(wanted, self.free))
+            self.free -= workers
+            return workers
+
+    def give(self, workers):
+        with self.lock:
+            self.free += workers
+
+
+class GenerationJob:
+    # Runs ScheduleGenerator.generate() on a daemon thread so the page that
+    # started it, and every other session, keeps rerunning while it searches.
+    # The page polls snapshot(); cancel() stops the search at its next progress
+    # report and the best roster found so far is still returned. With a
+    # WorkerBudget, options['workers'] is the most the job asks for.
+    def __init__(self, generator, budget=None, **options):
+        self.generator = generator
+        self.budget = budget
+        self.options = options
+        self.lock = threading.Lock()
+        self.cancel_event = threading.Event()
+        self.started = time.monotonic()
+        self.status = 'running'
+        self.progress = {'attempts': 0, 'deficit': None}
+        self.result = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.started = time.monotonic()
+        self.thread.start()
+        return self
+
+    def run(self):
+        options = dict(self.options)
+        if self.budget is not None:
+            options['workers'] = self.budget.take(options.get('workers', 1))
+        try:
+            result = self.generator.generate(on_progress=self.report, **options)
+        except Exception as e:
+            with self.lock:
+                self.status = 'error'
+                self.error = e
+            return
+        finally:
+            if self.budget is not None:
+                self.budget.give(options['workers'])
+        with self.lock:
+            self.result = result
+            self.status = 'cancelled' if self.cancel_event.is_set() else 'done'
+
+    def report(self, progress):
+        # Keep only the counters; the best schedule stays with the generator
+        with self.lock:
+            self.progress = {'attempts': progress['attempts'], 'deficit': progress['deficit']}
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def running(self):
+        return self.status == 'running'
+
+    def snapshot(self):
+        with self.lock:
+            return {'status': self.status, 'elapsed': time.monotonic() - self.started,
+                    'cancelling': self.cancel_event.is_set(), **self.progress}
@@ -0,0 +1,216 @@
+# Persistent roster store: staff, per-month requests and generated rosters of
+# every ward in one SQLite file, so they survive restarts and past months can
+# be queried.
+#
+#   store = RosterStore('shift_app.db')
+#   store.save_staff('本館3階', staff_list)
+#   store.save_requests('本館3階', 2026, 2, staff_list)
+#   store.save_roster('本館3階', 2026, 2, result['schedule'])
+#   store.shift_counts('本館3階', SHIFT_NIGHT, 2026, 3)   # {staff id: 夜 in the last 12 months}
+#
+# A staff member's requests or roster for one month is a single row whose
+# cells are one character per day (CELL_OF, '.' for none), so a ward-month is
+# one row per staff and counting a shift over many months is a string
+# operation inside SQLite. Rows are keyed (ward, month, staff) with month as
+# year * 100 + month. Every save is one transaction. Only the stdlib is used.
+
+import json
+import sqlite3
+import threading
+
+from scheduler import ALL_SHIFTS, SHIFT_DAWN, SHIFT_DAY, SHIFT_EARLY, SHIFT_LATE, SHIFT_NIGHT, SHIFT_OFF, SHIFT_PAID
+
+# One character per shift; stored data depends on this table, so only ever
+# add to it
+CELL_OF = {None: '.', SHIFT_EARLY: 'E', SHIFT_DAY: 'D', SHIFT_LATE: 'L', SHIFT_NIGHT: 'N', SHIFT_DAWN: 'A',
+           SHIFT_OFF: 'O', SHIFT_PAID: 'P'}
+SHIFT_OF_CELL = {cell: shift for shift, cell in CELL_OF.items()}
+HISTORY_MONTHS = 12
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ward (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS staff (
+    ward_id INTEGER NOT NULL,
+    staff_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    allowed_shifts TEXT NOT NULL,
+    limits TEXT,
+    PRIMARY KEY (ward_id, staff_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS request (
+    ward_id INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    staff_id INTEGER NOT NULL,
+    cells TEXT NOT NULL,
+    PRIMARY KEY (ward_id, month, staff_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS roster (
+    ward_id INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    staff_id INTEGER NOT NULL,
+    cells TEXT NOT NULL,
+    PRIMARY KEY (ward_id, month, staff_id)
+) WITHOUT ROWID;
+"""
+
+
+def month_key(year, month):
+    return year * 100 + month
+
+
+def months_back(year, month, count):
+    # (year, month) `count` months before the given one
+    index = year * 12 + month - 1 - count
+    return index // 12, index % 12 + 1
+
+
+def encode_cells(shifts):
+    # shifts[d] for d = 1..n (index 0 unused) -> "EDN.O..."
+    return ''.join(CELL_OF[shift or None] for shift in shifts[1:])
+
+
+def decode_cells(cells):
+    return [None] + [SHIFT_OF_CELL[cell] for cell in cells]
+
+
+class RosterStore:
+    # One connection, shared by every session of the server (hence the lock).
+    # Pool workers of batch.py open their own; SQLite serializes the writers,
+    # and every save takes the write lock up front (BEGIN IMMEDIATE).
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level="IMMEDIATE")
+        self.lock = threading.Lock()
+        self.ward_ids = {}
+        with self.lock, self.conn:
+            if path != ':memory:':
+                self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def ward_id(self, ward, create=False):
+        # Called with the lock held; None for an unknown ward unless create.
+        # With create it runs inside the caller's save transaction, so another
+        # process creating the same ward at once is waited for, not duplicated
+        ward_id = self.ward_ids.get(ward)
+        if ward_id is None:
+            if create:
+                self.conn.execute("INSERT OR IGNORE INTO ward (name) VALUES (?)", (ward,))
+            row = self.conn.execute("SELECT id FROM ward WHERE name = ?", (ward,)).fetchone()
+            if row is None:
+                return None
+            ward_id = self.ward_ids[ward] = row[0]
+        return ward_id
+
+    def wards(self):
+        with self.lock:
+            return [name for name, in self.conn.execute("SELECT name FROM ward ORDER BY name")]
+
+    # --- Staff ---
+
+    def save_staff(self, ward, staff_list):
+        # Replaces the ward's staff list; requests and rosters are kept
+        rows = []
+        for position, staff in enumerate(staff_list):
+            allowed = ''.join(shift for shift in ALL_SHIFTS if shift in (staff.get('allowed_shifts') or []))
+            limits = json.dumps(staff['limits'], sort_keys=True) if staff.get('limits') else None
+            rows.append((staff['id'], position, staff['name'], allowed, limits))
+        with self.lock, self.conn:
+            ward_id = self.ward_id(ward, create=True)
+            self.conn.execute("DELETE FROM staff WHERE ward_id = ?", (ward_id,))
+            self.conn.executemany("INSERT INTO staff VALUES (?, ?, ?, ?, ?, ?)",
+                                  [(ward_id,) + row for row in rows])
+
+    def load_staff(self, ward):
+        # The ward's staff list in app/config form (empty requests); [] if unknown
+        with self.lock:
+            ward_id = self.ward_id(ward)
+            if ward_id is None:
+                return []
+            rows = self.conn.execute(
+                "SELECT staff_id, name, allowed_shifts, limits FROM staff WHERE ward_id = ? ORDER BY position",
+                (ward_id,)).fetchall()
+        staff_list = []
+        for staff_id, name, allowed, limits in rows:
+            staff = {'id': staff_id, 'name': name, 'allowed_shifts': [shift for shift in ALL_SHIFTS if shift in allowed],
+                     'requests': {}}
+            if limits:
+                staff['limits'] = json.loads(limits)
+            staff_list.append(staff)
+        return staff_list
+
+    # --- Requests ---
+
+    def save_requests(self, ward, year, month, staff_list):
+        # Replaces the month's requests of every staff in staff_list
+        self.save_request_rows(ward, year, month, {staff['id']: staff.get('requests', {}) for staff in staff_list})
+
+    def save_request_rows(self, ward, year, month, requests):
+        # requests: {staff id: {"day": shift}}; other staff keep their rows
+        rows = []
+        for staff_id, days in requests.items():
+            cells = ['.'] * 31
+            for day, shift in days.items():
+                if shift:
+                    cells[int(day) - 1] = CELL_OF[shift]
+            rows.append((staff_id, ''.join(cells).rstrip('.')))
+        key = month_key(year, month)
+        with self.lock, self.conn:
+            ward_id = self.ward_id(ward, create=True)
+            self.conn.executemany("DELETE FROM request WHERE ward_id = ? AND month = ? AND staff_id = ?",
+                                  [(ward_id, key, staff_id) for staff_id, cells in rows if not cells])
+            self.conn.executemany("INSERT OR REPLACE INTO request VALUES (?, ?, ?, ?)",
+                                  [(ward_id, key, staff_id, cells) for staff_id, cells in rows if cells])
+
+    def load_requests(self, ward, year, month):
+        # {staff id: {"day": shift}} for the staff with requests that month
+        with self.lock:
+            ward_id = self.ward_id(ward)
+            if ward_id is None:
+                return {}
+            rows = self.conn.execute("SELECT staff_id, cells FROM request WHERE ward_id = ? AND month = ?",
+                                     (ward_id, month_key(year, month))).fetchall()
+        return {staff_id: {str(d): SHIFT_OF_CELL[cell] for d, cell in enumerate(cells, 1) if cell != '.'}
+                for staff_id, cells in rows}
+
+    # --- Rosters ---
+
+    def save_roster(self, ward, year, month, schedule):
+        # schedule: a result['schedule'] ({staff id: row}); replaces the month's roster
+        rows = [(staff_id, encode_cells(row)) for staff_id, row in schedule.items()]
+        key = month_key(year, month)
+        with self.lock, self.conn:
+            ward_id = self.ward_id(ward, create=True)
+            self.conn.execute("DELETE FROM roster WHERE ward_id = ? AND month = ?", (ward_id, key))
+            self.conn.executemany("INSERT INTO roster VALUES (?, ?, ?, ?)",
+                                  [(ward_id, key, staff_id, cells) for staff_id, cells in rows])
+
+    def load_roster(self, ward, year, month):
+        # The month's result['schedule'], or None if none was stored
+        with self.lock:
+            ward_id = self.ward_id(ward)
+            if ward_id is None:
+                return None
+            rows = self.conn.execute("SELECT staff_id, cells FROM roster WHERE ward_id = ? AND month = ?",
+                                     (ward_id, month_key(year, month))).fetchall()
+        return {staff_id: decode_cells(cells) for staff_id, cells in rows} or None
+
+    def shift_counts(self, ward, shift, year, month, months=HISTORY_MONTHS):
+        # {staff id: number of `shift`} over the stored rosters of the `months`
+        # months before (year, month), e.g. to balance night shifts
+        cell = CELL_OF[shift]
+        with self.lock:
+            ward_id = self.ward_id(ward)
+            if ward_id is None:
+                return {}
+            rows = self.conn.execute(
+                "SELECT staff_id, SUM(LENGTH(cells) - LENGTH(REPLACE(cells, ?, ''))) FROM roster "
+                "WHERE ward_id = ? AND month >= ? AND month < ? GROUP BY staff_id",
+                (cell, ward_id, month_key(*months_back(year, month, months)), month_key(year, month))).fetchall()
+        return dict(rows)
@@ -0,0 +1,71 @@
+from scheduler import ALL_SHIFTS, BIT, C_NIGHT, SHIFT_DAWN, SHIFT_NIGHT, SHIFT_OFF, SHIFT_PAID, ExactSolver, \
+    ScheduleGenerator
+
+HEADCOUNT = {'早': 1, '日': 1, '遅': 1, '夜': 1}
+WORK_SHIFTS = set(ALL_SHIFTS) | {SHIFT_DAWN}
+
+
+def ward(n_staff):
+    staff_list = [{'id': i, 'name': f"スタッフ{i}", 'allowed_shifts': list(ALL_SHIFTS), 'requests': {}}
+                  for i in range(1, n_staff + 1)]
+    staff_list[0]['requests'] = {'3': SHIFT_OFF, '10': SHIFT_PAID, '15': SHIFT_NIGHT}
+    return {'year': 2026, 'month': 2, 'staff_list': staff_list, 'headcount': HEADCOUNT}
+
+
+def test_feasible_ward_is_solved_within_the_rules():
+    config = ward(14)
+    result = ExactSolver(config, seed=0).solve(time_limit=10)
+    assert result['status'] == 'optimal'
+
+    generator = ScheduleGenerator(config)
+    assert generator.coverage_shortage(generator.to_matrix(result['schedule'])) == 0
+    rules = generator.rules
+    for i, staff in enumerate(config['staff_list']):
+        row = result['schedule'][staff['id']]
+        for day, shift in staff['requests'].items():
+            assert row[int(day)] == shift
+        # 夜→明→公, and a 明 only after a 夜
+        for d in generator.days:
+            if row[d] == SHIFT_NIGHT and d + 1 <= generator.days_in_month:
+                assert row[d + 1] == SHIFT_DAWN
+            if row[d] == SHIFT_NIGHT and d + 2 <= generator.days_in_month:
+                assert row[d + 2] == SHIFT_OFF
+            if row[d] == SHIFT_DAWN:
+                assert d > 1 and row[d - 1] == SHIFT_NIGHT
+        # A day shift may not start once the streak reached the limit; a 夜
+        # may be the limit's last day, its 明 comes on top
+        streak = 0
+        for d in generator.days:
+            if row[d] in WORK_SHIFTS:
+                if row[d] != SHIFT_DAWN:
+                    assert streak < rules.max_streak[i] + (row[d] == SHIFT_NIGHT)
+                streak += 1
+            else:
+                streak = 0
+        assert row.count(SHIFT_OFF) == max(rules.off_days[i], list(staff['requests'].values()).count(SHIFT_OFF))
+
+
+def test_ward_short_by_counting_is_infeasible():
+    result = ExactSolver(ward(10), seed=0).solve(time_limit=10)
+    assert result['status'] == 'infeasible'
+    assert not result['success']
+    assert result['reason']
+
+
+def test_undo_restores_the_counts():
+    solver = ExactSolver(ward(14), seed=0)
+    n = solver.n_staff
+    before = (list(solver.dom), list(solver.row_possible), list(solver.col_possible), list(solver.row_fixed),
+              list(solver.col_fixed), list(solver.row_open), list(solver.col_open))
+    mark = len(solver.trail)
+
+    # A 夜 on day 5 fixes the 明 and 公 after it through propagation
+    solver.narrow(5 * n + 1, BIT[C_NIGHT])
+    solver.propagate()
+    assert solver.col_possible != before[2]
+    assert len(solver.trail) > mark + 1
+
+    solver.undo_to(mark)
+    after = (solver.dom, solver.row_possible, solver.col_possible, solver.row_fixed, solver.col_fixed,
+             solver.row_open, solver.col_open)
+    assert [list(state) for state in after] == list(before)
@@ -0,0 +1,57 @@
+import copy
+
+from scheduler import ALL_SHIFTS, NO_NIGHT_SHIFTS, SHIFT_DAWN, SHIFT_NIGHT, SHIFT_OFF, SHIFT_PAID, \
+    ScheduleGenerator
+
+
+def base_roster():
+    staff_list = [{'id': i, 'name': f"スタッフ{i}", 'allowed_shifts': ALL_SHIFTS if i > 6 else NO_NIGHT_SHIFTS,
+                   'requests': {}} for i in range(1, 15)]
+    staff_list[2]['requests'] = {'8': SHIFT_OFF}
+    config = {'year': 2026, 'month': 4, 'staff_list': staff_list}
+    result = ScheduleGenerator(config, seed=3).generate(max_retries=30)
+    return config, result['schedule']
+
+
+def repair(config, schedule, edits):
+    # edits: {staff id: {"day": shift}} added to the requests of `config`
+    edited = copy.deepcopy(config)
+    for staff in edited['staff_list']:
+        staff['requests'].update(edits.get(staff['id'], {}))
+    previous = {staff['id']: dict(staff['requests']) for staff in config['staff_list']}
+    return edited, ScheduleGenerator(edited, seed=5).repair(schedule, previous)
+
+
+def test_repair_keeps_days_outside_the_window():
+    config, schedule = base_roster()
+    edited, result = repair(config, schedule, {1: {'20': SHIFT_OFF}, 9: {'12': SHIFT_NIGHT}})
+    window = set(result['repaired_days'])
+    assert 12 in window and 20 in window
+    days = range(1, len(result['days']) + 1)
+    assert len(window) < len(days)
+    for staff_id, row in result['schedule'].items():
+        for d in days:
+            if d not in window:
+                assert row[d] == schedule[staff_id][d]
+
+
+def test_repair_honors_the_edited_requests():
+    config, schedule = base_roster()
+    edits = {1: {'20': SHIFT_OFF}, 4: {'5': SHIFT_PAID}, 9: {'12': SHIFT_NIGHT}}
+    edited, result = repair(config, schedule, edits)
+    for staff_id, requests in edits.items():
+        for day, shift in requests.items():
+            assert result['schedule'][staff_id][int(day)] == shift
+    assert result['schedule'][9][13] == SHIFT_DAWN
+    # Earlier requests stay honored too
+    assert result['schedule'][3][8] == SHIFT_OFF
+
+
+def test_repair_without_edits_changes_nothing():
+    config, schedule = base_roster()
+    # Entering a request again as it was is no edit either
+    for edits in ({}, {3: {'8': SHIFT_OFF}}):
+        edited, result = repair(config, schedule, edits)
+        assert result['repaired_days'] == []
+        assert result['changed_cells'] == 0
+        assert result['schedule'] == schedule
@@ -0,0 +1,71 @@
+import pytest
+
+from scheduler import SHIFT_DAWN, SHIFT_DAY, SHIFT_EARLY, SHIFT_LATE, SHIFT_NIGHT, SHIFT_OFF, SHIFT_PAID
+from store import CELL_OF, RosterStore, decode_cells, encode_cells, months_back
+
+WARD = "本館3階"
+
+
+@pytest.fixture
+def store():
+    store = RosterStore(':memory:')
+    yield store
+    store.close()
+
+
+def roster_with_nights(nights, days=28):
+    # {staff id: row} with staff 1 on 夜 `nights` times and 2 always off
+    row = [None] + [SHIFT_NIGHT] * nights + [SHIFT_DAY] * (days - nights)
+    return {1: row, 2: [None] + [SHIFT_OFF] * days}
+
+
+def test_cell_codes_are_fixed():
+    # Stored rows depend on these characters
+    assert CELL_OF == {None: '.', SHIFT_EARLY: 'E', SHIFT_DAY: 'D', SHIFT_LATE: 'L', SHIFT_NIGHT: 'N',
+                       SHIFT_DAWN: 'A', SHIFT_OFF: 'O', SHIFT_PAID: 'P'}
+
+
+def test_cells_round_trip():
+    row = [None, SHIFT_EARLY, SHIFT_DAY, SHIFT_LATE, SHIFT_NIGHT, SHIFT_DAWN, SHIFT_OFF, SHIFT_PAID, None, ""]
+    cells = encode_cells(row)
+    assert cells == "EDLNAOP.."
+    assert decode_cells(cells) == row[:-1] + [None]
+
+
+def test_roster_round_trip(store):
+    schedule = {1: [None, SHIFT_NIGHT, SHIFT_DAWN, SHIFT_OFF, SHIFT_EARLY],
+                2: [None, None, SHIFT_LATE, SHIFT_PAID, SHIFT_DAY]}
+    store.save_roster(WARD, 2026, 2, schedule)
+    assert store.load_roster(WARD, 2026, 2) == schedule
+    assert store.load_roster(WARD, 2026, 3) is None
+    assert store.load_roster("別病棟", 2026, 2) is None
+
+
+def test_request_rows_that_become_empty_are_deleted(store):
+    store.save_request_rows(WARD, 2026, 2, {1: {'3': SHIFT_OFF, '31': SHIFT_PAID}, 2: {'1': SHIFT_NIGHT}})
+    assert store.load_requests(WARD, 2026, 2) == {1: {'3': SHIFT_OFF, '31': SHIFT_PAID}, 2: {'1': SHIFT_NIGHT}}
+
+    # Staff 1's cleared row goes, staff 2 (not passed) keeps theirs
+    store.save_request_rows(WARD, 2026, 2, {1: {'3': None, '31': ""}})
+    assert store.load_requests(WARD, 2026, 2) == {2: {'1': SHIFT_NIGHT}}
+    assert store.conn.execute("SELECT COUNT(*) FROM request").fetchone() == (1,)
+
+
+def test_months_back_crosses_years():
+    assert months_back(2026, 3, 12) == (2025, 3)
+    assert months_back(2026, 1, 1) == (2025, 12)
+    assert months_back(2026, 12, 12) == (2025, 12)
+    assert months_back(2026, 2, 14) == (2024, 12)
+
+
+def test_shift_counts_cover_the_months_before(store):
+    # One roster per month from 2025-02 to 2026-03; month m of the list has m nights
+    for n, (year, month) in enumerate([(2025, m) for m in range(2, 13)] + [(2026, 1), (2026, 2), (2026, 3)], 1):
+        store.save_roster(WARD, year, month, roster_with_nights(n))
+
+    # 2025-03 to 2026-02: not 2025-02 (1 night) nor the month asked about (14)
+    assert store.shift_counts(WARD, SHIFT_NIGHT, 2026, 3) == {1: sum(range(2, 14)), 2: 0}
+    assert store.shift_counts(WARD, SHIFT_NIGHT, 2026, 3, months=1) == {1: 13, 2: 0}
+    assert store.shift_counts(WARD, SHIFT_OFF, 2026, 3, months=2)[2] == 2 * 28
+    assert store.shift_counts(WARD, SHIFT_NIGHT, 2025, 2) == {}
+    assert store.shift_counts("別病棟", SHIFT_NIGHT, 2026, 3) == {}